@@ -2,22 +2,88 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import os
-from typing import List
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
 
-# Server settings
-SMTP_HOST = os.getenv('SMTP_HOST', '')
-SMTP_PORT = int(os.getenv('SMTP_PORT', '1025'))
-MAX_MESSAGE_SIZE = int(os.getenv('SMTP_MAX_MESSAGE_SIZE', str(100 * 1024 * 1024)))  # 100MB default
-MAX_STORED_MESSAGES = int(os.getenv('SMTP_MAX_STORED_MESSAGES', '500'))
-
-# Local domains configuration
 # Принимаем домены как строку, разделенную запятыми
 DEFAULT_DOMAINS = 'example.com'
-LOCAL_DOMAINS_STR = os.getenv('SMTP_LOCAL_DOMAINS', DEFAULT_DOMAINS)
-LOCAL_DOMAINS = [domain.strip() for domain in LOCAL_DOMAINS_STR.split(',') if domain.strip()]
 
-TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+
+def _env_int(name: str, default: int) -> int:
+    """Читает целочисленную переменную окружения, пустое значение - значение по умолчанию"""
+    value = os.getenv(name, '').strip()
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer, got {value!r}") from None
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Настройки приложения, один раз прочитанные из переменных окружения"""
+    # Server settings
+    smtp_host: str
+    smtp_port: int
+    max_message_size: int
+    max_stored_messages: int
+    # Сколько принятых писем может ждать отправки в Telegram
+    delivery_queue_size: int
+    # Число фоновых задач, отправляющих письма из очереди
+    delivery_workers: int
+    # Число процессов, принимающих письма на одном порту (SO_REUSEPORT)
+    worker_processes: int
+    # Local domains configuration
+    local_domains: Tuple[str, ...]
+    # Telegram settings
+    telegram_bot_token: Optional[str]
+    # Размер пула HTTP-соединений к Telegram Bot API
+    telegram_connection_pool_size: int
+    # Таймауты чтения ответа и отправки запроса к Telegram, секунды;
+    # запись дольше, чтобы успевали загружаться крупные вложения
+    telegram_read_timeout: int
+    telegram_write_timeout: int
+    # Сколько секунд ждать свободного соединения в пуле
+    telegram_pool_timeout: int
+    # Проактивные лимиты Telegram: запросов в секунду на бота
+    # и сообщений в минуту в один чат
+    telegram_global_rate_limit: int
+    telegram_chat_rate_limit: int
+    # Число повторов запроса к Telegram при flood control и сетевых ошибках
+    telegram_max_retries: int
+    # Максимум одновременных отправок в Telegram (ограничивает память под вложения в полете)
+    telegram_max_concurrent_sends: int
+
+    @classmethod
+    def from_env(cls) -> 'Settings':
+        """Собирает настройки из переменных окружения"""
+        local_domains_str = os.getenv('SMTP_LOCAL_DOMAINS', DEFAULT_DOMAINS)
+        return cls(
+            smtp_host=os.getenv('SMTP_HOST', ''),
+            smtp_port=_env_int('SMTP_PORT', 1025),
+            max_message_size=_env_int('SMTP_MAX_MESSAGE_SIZE', 100 * 1024 * 1024),  # 100MB default
+            max_stored_messages=_env_int('SMTP_MAX_STORED_MESSAGES', 500),
+            delivery_queue_size=_env_int('SMTP_DELIVERY_QUEUE_SIZE', 100),
+            delivery_workers=_env_int('SMTP_DELIVERY_WORKERS', 4),
+            worker_processes=_env_int('SMTP_WORKER_PROCESSES', 1),
+            local_domains=tuple(
+                domain.strip() for domain in local_domains_str.split(',') if domain.strip()
+            ),
+            telegram_bot_token=os.getenv('TELEGRAM_BOT_TOKEN'),
+            telegram_connection_pool_size=_env_int('TELEGRAM_CONNECTION_POOL_SIZE', 32),
+            telegram_read_timeout=_env_int('TELEGRAM_READ_TIMEOUT', 30),
+            telegram_write_timeout=_env_int('TELEGRAM_WRITE_TIMEOUT', 60),
+            telegram_pool_timeout=_env_int('TELEGRAM_POOL_TIMEOUT', 5),
+            telegram_global_rate_limit=_env_int('TELEGRAM_GLOBAL_RATE_LIMIT', 30),
+            telegram_chat_rate_limit=_env_int('TELEGRAM_CHAT_RATE_LIMIT', 20),
+            telegram_max_retries=_env_int('TELEGRAM_MAX_RETRIES', 3),
+            telegram_max_concurrent_sends=_env_int('TELEGRAM_MAX_CONCURRENT_SENDS', 8),
+        )
+
+
+SETTINGS = Settings.from_env()
 
 def get_local_domains() -> List[str]:
     """Получить список локальных доменов из переменных окружения"""
-    return LOCAL_DOMAINS 
+    return list(SETTINGS.local_domains)
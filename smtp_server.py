@@ -1,57 +1,415 @@
 import logging
+import logging.handlers
 import aiosmtpd.controller
 from aiosmtpd.smtp import Envelope, Session, SMTP
-from email.parser import BytesParser
+from email.parser import BytesFeedParser, BytesHeaderParser
 from email.policy import default
+from email.message import EmailMessage
+from email.header import decode_header, make_header
 from email.utils import parseaddr
-from typing import Optional, Dict, List, Tuple
-from dataclasses import dataclass
-from datetime import datetime
+from typing import Optional, Dict, List, Tuple, Callable, Awaitable, Any, FrozenSet
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
 import os
 import asyncio
-from collections import deque
+import functools
+import multiprocessing
+import random
+from collections import OrderedDict, deque
+import queue
 import re
-from config import (
-    SMTP_HOST,
-    SMTP_PORT,
-    MAX_MESSAGE_SIZE,
-    MAX_STORED_MESSAGES,
-    get_local_domains,
-    TELEGRAM_BOT_TOKEN
-)
+import signal
+import string
+import tempfile
+import time
+from config import SETTINGS, get_local_domains
 
 from telegram import Bot, InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio, InputMediaAnimation
-from telegram.error import TelegramError
+from telegram.error import TelegramError, RetryAfter, NetworkError, BadRequest
+from telegram.request import HTTPXRequest
 import html
 import mimetypes
-from io import BytesIO
+try:
+    # SIMD-реализация base64 (AVX2/AVX-512), если установлена
+    import pybase64 as base64
+except ImportError:
+    import base64
+try:
+    # Разбор писем на Rust, в разы быстрее email.parser; без него - stdlib
+    import fast_mail_parser
+except ImportError:
+    fast_mail_parser = None
+try:
+    # Определение кодировки писем без charset
+    from charset_normalizer import from_bytes as detect_encodings
+except ImportError:
+    detect_encodings = None
 from pathlib import Path
 
+# Максимальное число файлов в одной медиагруппе Telegram
+MEDIA_GROUP_LIMIT = 10
+
+# Типы медиа, которые Telegram разрешает смешивать в одной медиагруппе
+MIXABLE_MEDIA_TYPES = ('photo', 'video')
+
+# Метод Bot API и имя его аргумента с файлом для каждого типа медиа
+MEDIA_SENDERS = {
+    'photo': ('send_photo', 'photo'),
+    'video': ('send_video', 'video'),
+    'audio': ('send_audio', 'audio'),
+    'animation': ('send_animation', 'animation'),
+    'document': ('send_document', 'document'),
+}
+
+# Классы элементов медиагруппы; анимации в медиагруппы не входят
+INPUT_MEDIA_TYPES = {
+    'photo': InputMediaPhoto,
+    'video': InputMediaVideo,
+    'audio': InputMediaAudio,
+    'document': InputMediaDocument,
+}
+
+# HTML-теги, вырезаемые из html_body для текстового превью
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+
+# Сколько разобранных адресов получателей держать в кэше
+RECIPIENT_CACHE_SIZE = 4096
+
+# Лимит длины текста сообщения Telegram
+TELEGRAM_TEXT_LIMIT = 4096
+
+# Лимит длины подписи к медиа в Telegram
+TELEGRAM_CAPTION_LIMIT = 1024
+
+# Сколько символов тела письма берется в превью до экранирования;
+# запас до лимита оставлен на рост текста при экранировании
+PREVIEW_BODY_CHARS = 3500
+
+# Базовая и максимальная задержка повтора запроса к Telegram, в секундах
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+# Сколько секунд при остановке ждать отправки уже принятых писем и закрытия
+# соединений бота. Вместе они укладываются в 10 секунд, которые docker stop
+# по умолчанию дает до SIGKILL; для более долгой досылки нужен --stop-timeout
+DELIVERY_DRAIN_TIMEOUT = 7
+BOT_SHUTDOWN_TIMEOUT = 2
+
+# Размер порции, которой письмо подается парсеру
+PARSE_CHUNK_SIZE = 64 * 1024
+
+# Вложения крупнее этого размера ждут отправки во временном файле, а не в памяти
+ATTACHMENT_SPOOL_SIZE = 1024 * 1024
+
+# Парсер блока заголовков не хранит состояния между вызовами (каждый
+# разбор создает свой FeedParser), поэтому один экземпляр общий для всех потоков
+HEADER_PARSER = BytesHeaderParser(policy=default)
+
+# Обязательные заголовки в нижнем регистре с началом строки перед именем
+REQUIRED_HEADER_PREFIXES = (b'\nfrom:', b'\nto:')
+
+def header_block(content: bytes) -> bytes:
+    """Блок заголовков письма: все до первой пустой строки (CRLF или LF)"""
+    header_end = len(content)
+    for separator in (b'\r\n\r\n', b'\n\n'):
+        position = content.find(separator, 0, header_end)
+        if position != -1:
+            header_end = position
+    return content[:header_end]
+
+def has_required_headers(headers: bytes) -> bool:
+    """Быстрая проверка наличия обязательных заголовков по сырым байтам.
+
+    Принимает блок заголовков (см. header_block) и не разбирает письмо;
+    используется, чтобы отсеять некорректные письма до парсера.
+    """
+    headers = b'\n' + headers.lower()
+    return all(prefix in headers for prefix in REQUIRED_HEADER_PREFIXES)
+
+def has_required_header_values(message: EmailMessage) -> bool:
+    """Проверяет, что обязательные заголовки не пустые.
+
+    Принимает блок заголовков, разобранный HEADER_PARSER без тела письма.
+    Смотрим сырые значения, не запуская разбор адресов, который политика
+    default выполняет при get().
+    """
+    present_headers = {name.lower() for name, value in message.raw_items() if value.strip()}
+    return 'from' in present_headers and 'to' in present_headers
+
+def parse_email_bytes(content: bytes):
+    """Разбирает письмо, подавая его парсеру порциями.
+
+    В отличие от BytesParser.parsebytes не создает полную строковую копию
+    сообщения перед разбором.
+    """
+    parser = BytesFeedParser(policy=default)
+    for offset in range(0, len(content), PARSE_CHUNK_SIZE):
+        parser.feed(content[offset:offset + PARSE_CHUNK_SIZE])
+    return parser.close()
+
+# Префиксы MIME-типов, по которым вложение отправляется как медиа Telegram;
+# все остальное уходит документом
+MEDIA_TYPES = {
+    'photo': (
+        'image/',
+        'application/png',
+        'application/jpg',
+        'application/jpeg'
+    ),
+    'video': (
+        'video/',
+        'application/mp4',
+        'application/mpeg'
+    ),
+    'audio': (
+        'audio/',
+        'application/ogg',
+        'application/mp3',
+        'application/wav'
+    )
+}
+
+# Точные MIME-типы, которые проверяются раньше префиксов
+MEDIA_EXACT_TYPES = {
+    'image/gif': 'animation'
+}
+
+# Плоская таблица (префикс, тип): более длинные префиксы проверяются первыми
+MEDIA_PREFIXES = tuple(sorted(
+    ((prefix, media_type) for media_type, prefixes in MEDIA_TYPES.items() for prefix in prefixes),
+    key=lambda item: -len(item[0])
+))
+
+def classify_media_type(content_type: str) -> str:
+    """Определяет тип медиа Telegram по MIME-типу вложения в нижнем регистре"""
+    media_type = MEDIA_EXACT_TYPES.get(content_type)
+    if media_type is not None:
+        return media_type
+    return next(
+        (media_type for prefix, media_type in MEDIA_PREFIXES if content_type.startswith(prefix)),
+        'document'
+    )
+
+def guess_charset(payload: bytes) -> str:
+    """Угадывает кодировку текста без заявленного charset.
+
+    Корректный UTF-8 принимается сразу; полный анализ через
+    charset-normalizer запускается только для остального.
+    """
+    try:
+        payload.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    if detect_encodings is None:
+        return 'utf-8'
+    best = detect_encodings(payload).best()
+    return best.encoding if best is not None else 'utf-8'
+
+def decode_text_part(part) -> str:
+    """Декодирует текстовую часть письма с учетом ее charset.
+
+    Чисто ASCII-содержимое (самый частый случай) декодируется быстрым путем,
+    остальное - по заявленной кодировке с заменой некорректных байтов.
+    Кодировка угадывается, только если она не указана в письме.
+    """
+    payload = part.get_payload(decode=True)
+    if not payload:
+        return ''
+    if payload.isascii():
+        return payload.decode('ascii')
+    charset = part.get_content_charset()
+    if charset is None:
+        charset = guess_charset(payload)
+    try:
+        return payload.decode(charset, errors='replace')
+    except LookupError:
+        # Неизвестная кодировка в заголовке
+        return payload.decode('utf-8', errors='replace')
+
+def decode_attachment_payload(part) -> Optional[bytes]:
+    """Возвращает декодированное содержимое вложения.
+
+    Вложения в base64 декодируются напрямую (через pybase64, если он есть);
+    при ошибке или другой кодировке используется стандартный get_payload.
+    """
+    if not part.is_multipart() and str(part.get('Content-Transfer-Encoding', '')).strip().lower() == 'base64':
+        try:
+            return base64.b64decode(part.get_payload(), validate=False)
+        except ValueError:
+            # Некорректное выравнивание или не-ASCII символы - пусть разбирается email
+            pass
+    return part.get_payload(decode=True)
+
+def split_from_header(from_header) -> Tuple[str, str]:
+    """Возвращает (отображаемое имя, адрес) отправителя с раскодированными encoded-word.
+
+    Заголовок политики default уже разобран и раскодирован; строку (например,
+    из другой политики) раскодируем и разбираем сами.
+    """
+    addresses = getattr(from_header, 'addresses', None)
+    if addresses:
+        return addresses[0].display_name, addresses[0].addr_spec
+    try:
+        decoded = str(make_header(decode_header(str(from_header))))
+    except Exception:
+        decoded = str(from_header)
+    return parseaddr(decoded)
+
+def _format_sender(message_dict: Dict) -> str:
+    """Отправитель для превью: «Имя <адрес>» или только адрес"""
+    display_name = message_dict.get('from_display')
+    address = message_dict.get('from_addr')
+    if not address:
+        return str(message_dict['from'])
+    return f"{display_name} <{address}>" if display_name else address
+
+# База MIME-типов загружается при импорте, а не при первом вложении без имени
+mimetypes.init()
+
+@functools.lru_cache(maxsize=256)
+def _extension_for(content_type: str) -> str:
+    """Расширение файла для MIME-типа или пустая строка"""
+    return mimetypes.guess_extension(content_type) or ''
+
+def default_attachment_name(index: int, content_type: str) -> str:
+    """Имя для вложения без filename: attachment_<номер><расширение>"""
+    return f'attachment_{index}{_extension_for(content_type)}'
+
+def _truncate_escaped(text: str, limit: int) -> str:
+    """Обрезает экранированный текст, не разрывая HTML-сущности вида &amp;"""
+    if len(text) <= limit:
+        return text
+    text = text[:max(limit, 0)]
+    amp = text.rfind('&')
+    if amp != -1 and ';' not in text[amp:]:
+        text = text[:amp]
+    return text
+
+def strip_html_tags(html_body: str, limit: int) -> str:
+    """Текст html_body без тегов; достаточно первых limit символов результата.
+
+    Теги вырезаются сначала только из начала документа, обрезанного перед
+    незакрытым тегом, - результат для него тот же, что и для всего документа.
+    Весь документ обрабатывается, только если в начале не набралось текста.
+    """
+    prefix = html_body[:limit * 4]
+    if len(prefix) < len(html_body):
+        last_close = prefix.rfind('>')
+        open_tag = prefix.find('<', last_close + 1)
+        if open_tag != -1:
+            prefix = prefix[:open_tag]
+        text = HTML_TAG_RE.sub('', prefix)
+        if len(text) >= limit:
+            return text
+    return HTML_TAG_RE.sub('', html_body)
+
+def format_preview_text(message_dict: Dict) -> str:
+    """Текст уведомления о письме для Telegram.
+
+    Готовится один раз на письмо и запоминается в message_dict, чтобы
+    получатели одного письма не экранировали тело заново.
+    """
+    text = message_dict.get('preview_text')
+    if text is not None:
+        return text
+
+    text = (
+        "📧 <b>Новое email сообщение</b>\n\n"
+        f"<b>От:</b> {html.escape(_format_sender(message_dict), quote=False)}\n"
+        f"<b>Тема:</b> {html.escape(message_dict['subject'], quote=False)}\n\n"
+    )
+    body = message_dict['text_body']
+    if not body and message_dict['html_body']:
+        body = strip_html_tags(message_dict['html_body'], PREVIEW_BODY_CHARS)
+    if body:
+        preview = html.escape(body[:PREVIEW_BODY_CHARS], quote=False)
+        text += _truncate_escaped(preview, TELEGRAM_TEXT_LIMIT - len(text) - 3) + "..."
+
+    message_dict['preview_text'] = text
+    return text
+
+def spool_attachments(attachments: List[Dict]) -> None:
+    """Переносит содержимое крупных вложений во временные файлы.
+
+    Письмо может долго ждать в очереди отправки, и все это время его
+    вложения занимали бы память. Файлы удаляются при закрытии или сборке мусора.
+    """
+    for attachment in attachments:
+        content = attachment['content']
+        if isinstance(content, bytes) and len(content) > ATTACHMENT_SPOOL_SIZE:
+            spool = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_SIZE)
+            spool.write(content)
+            attachment['content'] = spool
+
+def has_spooled_attachments(attachments: List[Dict]) -> bool:
+    """Есть ли среди вложений перенесенные во временные файлы"""
+    return any(isinstance(attachment['content'], tempfile.SpooledTemporaryFile) for attachment in attachments)
+
+def load_attachments(attachments: List[Dict]) -> None:
+    """Возвращает в память содержимое вложений из временных файлов перед отправкой"""
+    for attachment in attachments:
+        spool = attachment['content']
+        if isinstance(spool, tempfile.SpooledTemporaryFile):
+            with spool:
+                spool.seek(0)
+                attachment['content'] = spool.read()
+
+def discard_spooled_attachments(attachments: List[Dict]) -> None:
+    """Закрывает временные файлы вложений письма, которое не будет отправлено"""
+    for attachment in attachments:
+        spool = attachment['content']
+        if isinstance(spool, tempfile.SpooledTemporaryFile):
+            spool.close()
+
 @dataclass
 class ServerConfig:
     """SMTP Server configuration"""
-    hostname: str = SMTP_HOST
-    port: int = SMTP_PORT
-    max_message_size: int = MAX_MESSAGE_SIZE
-    max_stored_messages: int = MAX_STORED_MESSAGES
+    hostname: str = SETTINGS.smtp_host
+    port: int = SETTINGS.smtp_port
+    max_message_size: int = SETTINGS.max_message_size
+    max_stored_messages: int = SETTINGS.max_stored_messages
+    delivery_queue_size: int = SETTINGS.delivery_queue_size
+    delivery_workers: int = SETTINGS.delivery_workers
+    worker_processes: int = SETTINGS.worker_processes
     local_domains: List[str] = None
+    # Домены в нижнем регистре для проверки получателя за O(1)
+    local_domains_set: FrozenSet[str] = field(init=False, repr=False)
     
     def __post_init__(self):
         if self.max_message_size <= 0:
             raise ValueError("max_message_size must be positive")
         if self.max_stored_messages <= 0:
             raise ValueError("max_stored_messages must be positive")
+        if self.delivery_queue_size <= 0:
+            raise ValueError("delivery_queue_size must be positive")
+        if self.delivery_workers <= 0:
+            raise ValueError("delivery_workers must be positive")
+        if self.worker_processes <= 0:
+            raise ValueError("worker_processes must be positive")
+        # Лимиты Telegram делятся между процессами: каждому нужен хотя бы
+        # один запрос, иначе в сумме процессы превысят заданный лимит
+        if self.worker_processes > min(SETTINGS.telegram_global_rate_limit,
+                                       SETTINGS.telegram_chat_rate_limit):
+            raise ValueError("worker_processes must not exceed the Telegram rate limits")
         # Инициализируем список доменов из конфигурации
         if self.local_domains is None:
             self.local_domains = get_local_domains()
         # Проверяем, что список доменов не пустой
         if not self.local_domains:
             raise ValueError("local_domains cannot be empty")
-        print(f'hostname: {self.hostname}')
+        self.local_domains_set = frozenset(domain.lower() for domain in self.local_domains)
+        logging.getLogger(__name__).debug('hostname: %s', self.hostname)
 
 class EmailValidator:
-    """Email validation utility"""
-    EMAIL_REGEX = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+    """Email validation utility
+
+    Проверяет адрес вида local@host.tld линейным проходом по множествам
+    допустимых символов, без регулярного выражения с возвратами.
+    """
+    LOCAL_CHARS = frozenset(string.ascii_letters + string.digits + '._%+-')
+    DOMAIN_CHARS = frozenset(string.ascii_letters + string.digits + '.-')
+    TLD_CHARS = frozenset(string.ascii_letters)
     
     @classmethod
     def is_valid_email(cls, email: str) -> bool:
@@ -59,76 +417,222 @@ class EmailValidator:
         if not email:
             return False
         _, addr = parseaddr(email)
-        return bool(cls.EMAIL_REGEX.match(addr))
+        local, at, domain = addr.partition('@')
+        if not at or not local or not cls.LOCAL_CHARS.issuperset(local):
+            return False
+        # Домен верхнего уровня - только буквы, поэтому он идет после последней точки
+        host, dot, tld = domain.rpartition('.')
+        return (
+            bool(dot) and bool(host) and len(tld) >= 2
+            and cls.DOMAIN_CHARS.issuperset(host)
+            and cls.TLD_CHARS.issuperset(tld)
+        )
 
 @dataclass
+class StoredMessage:
+    """Краткая запись о принятом письме для истории.
+
+    Хранит только метаданные: содержимое тела и вложений освобождается
+    сразу после отправки в Telegram.
+    """
+    mail_from: str
+    rcpt_tos: Tuple[str, ...]
+    subject: str
+    date: str
+    size: int
+    # None - тело письма без локальных получателей не разбиралось
+    attachment_count: Optional[int]
+    is_local_delivery: bool = False
+    # 'skipped' - нет локальных получателей, 'queued' - ждет отправки,
+    # 'delivered' / 'failed' - результат отправки в Telegram
+    delivery_status: str = 'skipped'
+
+@dataclass(frozen=True)
 class LocalRecipient:
     """Структура данных для локального получателя"""
     chat_id: str
     message_thread_id: Optional[str] = None
     
+    # [id]<chat_id>[!_<message_thread_id>]: chat_id отрицательный у групп и каналов
+    LOCAL_NAME_RE = re.compile(r'(?:id)?(-?\d+)(?:[!_](\d+))?')
+    
     @classmethod
     def parse(cls, local_name: str) -> Optional['LocalRecipient']:
         """Парсит локальное имя и возвращает структуру LocalRecipient"""
-        if not local_name:
+        match = cls.LOCAL_NAME_RE.fullmatch(local_name)
+        if match is None:
             return None
-            
-        parts = local_name.split('!')
-            
-        if len(parts) == 1:
-            parts = local_name.split('_')
-                
-        # Если только одна часть, предполагается, что это chat_id
-        if len(parts) == 1:
-            chat_id = parts[0].lstrip("id")  # Убираем префикс "id" если он есть
-            return cls(chat_id=chat_id)
-        
-        # Если две части, предполагается, что это chat_id и message_thread_id
-        elif len(parts) == 2:
-            chat_id = parts[0].lstrip("id")  # Убираем префикс "id" если он есть
-            message_thread_id = parts[1]
-            return cls(chat_id=chat_id, message_thread_id=message_thread_id)
+        chat_id, message_thread_id = match.groups()
+        return cls(chat_id=chat_id, message_thread_id=message_thread_id)
+
+@functools.lru_cache(maxsize=RECIPIENT_CACHE_SIZE)
+def resolve_local_recipient(
+    rcpt: str, local_domains: FrozenSet[str]
+) -> Optional[Tuple[str, Optional[LocalRecipient]]]:
+    """Разбирает адрес получателя: (домен, получатель в Telegram) или None.
 
+    None означает, что адрес не принадлежит локальным доменам; получатель
+    None - что локальное имя не описывает чат. Результат кэшируется по
+    исходной строке адреса, поэтому повторяющиеся адреса не разбираются заново.
+    """
+    local_name, at, domain = parseaddr(rcpt)[1].rpartition('@')
+    domain = domain.lower()
+    if not at or domain not in local_domains:
+        return None
+    return domain, LocalRecipient.parse(local_name)
+
+class TokenBucket:
+    """Асинхронный ограничитель частоты: не больше rate запросов за period секунд.
+
+    Токены пополняются непрерывно; ожидающие получают их по очереди.
+    """
+
+    def __init__(self, rate: int, period: float):
+        if rate <= 0 or period <= 0:
+            raise ValueError("rate and period must be positive")
+        self.rate = rate
+        self.period = period
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        # Создается в цикле событий при первом ожидании
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def acquire(self) -> None:
+        """Ждет свободный токен и забирает его"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.rate, self._tokens + (now - self._updated) * self.rate / self.period
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * self.period / self.rate)
+
+    async def __aenter__(self) -> 'TokenBucket':
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
         return None
 
 class CustomSMTPHandler:
     """SMTP request handler"""
 
+    # Общий для всех обработчиков бот: один пул соединений на процесс
+    _bot: Optional[Bot] = None
+
     def __init__(self, config: ServerConfig):
         self.config = config
         self.messages: deque = deque(maxlen=config.max_stored_messages)
         self.logger = logging.getLogger(__name__)
-        self.bot = Bot(token=TELEGRAM_BOT_TOKEN)
+        self.bot = self._get_bot()
+        # Создаются в цикле событий контроллера при первой отправке
+        self._send_semaphore: Optional[asyncio.Semaphore] = None
+        self._delivery_queue: Optional[asyncio.Queue] = None
+        self._delivery_workers: List[asyncio.Task] = []
+        # Лимиты Telegram соблюдаем заранее, а не только по ответу RetryAfter.
+        # Бот общий для всех процессов, поэтому лимиты делятся между ними
+        self._global_limiter = TokenBucket(
+            SETTINGS.telegram_global_rate_limit // config.worker_processes, 1
+        )
+        self._chat_limiters: 'OrderedDict[str, TokenBucket]' = OrderedDict()
+        # Очередность отправки в пределах одного чата; блокировка живет,
+        # пока ее держит или ждет хотя бы одна отправка
+        self._chat_locks: Dict[str, asyncio.Lock] = {}
+        self._chat_lock_users: Dict[str, int] = {}
 
-    async def validate_envelope(self, envelope: Envelope) -> Tuple[bool, str]:
-        """Validate envelope data"""
+    @classmethod
+    def _get_bot(cls) -> Bot:
+        """Возвращает общий экземпляр Bot, создавая его при первом обращении"""
+        if cls._bot is None:
+            # Пул keep-alive соединений: параллельные загрузки файлов не ждут
+            # друг друга и не проходят TLS-рукопожатие заново
+            request = HTTPXRequest(
+                connection_pool_size=SETTINGS.telegram_connection_pool_size,
+                read_timeout=SETTINGS.telegram_read_timeout,
+                write_timeout=SETTINGS.telegram_write_timeout,
+                pool_timeout=SETTINGS.telegram_pool_timeout
+            )
+            # getUpdates ретранслятор не вызывает: отдельный клиент для него
+            # не создаем, весь бот работает через один пул
+            cls._bot = Bot(
+                token=SETTINGS.telegram_bot_token,
+                request=request,
+                get_updates_request=request
+            )
+        return cls._bot
+
+    async def validate_envelope(self, envelope: Envelope, parse_body: bool = True) -> Tuple[bool, str, Any]:
+        """Validate envelope data
+
+        Возвращает (валидно ли письмо, SMTP-ответ при ошибке, разобранное письмо),
+        чтобы вызывающий код не разбирал сообщение повторно. С parse_body=False
+        разбирается только блок заголовков, а тело парсеру не передается.
+        """
         if len(envelope.content) > self.config.max_message_size:
-            return False, '552 Message size exceeds fixed maximum message size'
+            return False, '552 Message size exceeds fixed maximum message size', None
             
         if len(envelope.content) < 50:
-            return False, '451 Invalid message content'
+            return False, '451 Invalid message content', None
             
         try:
-            email_message = BytesParser(policy=default).parsebytes(envelope.content)
-            if not email_message.get('From') or not email_message.get('To'):
-                return False, '451 Missing required headers'
+            # Письма без обязательных заголовков отсекаем до разбора тела:
+            # сначала поиском по байтам, затем разбором одного блока заголовков
+            headers = header_block(envelope.content)
+            if not has_required_headers(headers):
+                return False, '451 Missing required headers', None
+            header_message = HEADER_PARSER.parsebytes(headers)
+            if not has_required_header_values(header_message):
+                return False, '451 Missing required headers', None
+
+            if not parse_body:
+                return True, '', header_message
+
+            # Разбор MIME занимает процессор: выполняем его в потоке, чтобы
+            # не задерживать другие SMTP-сессии и отправку в Telegram
+            email_message = await asyncio.to_thread(self._parse_email, envelope.content)
         except Exception as e:
-            self.logger.error(f'Error parsing message: {e}')
-            return False, '451 Invalid message format'
+            self.logger.error('Error parsing message: %s', e)
+            return False, '451 Invalid message format', None
             
-        return True, ''
+        return True, '', email_message
+
+    def _parse_email(self, content: bytes):
+        """Разбирает письмо доступным парсером.
+
+        fast_mail_parser отказывается разбирать письмо целиком из-за одной
+        испорченной части (например, битого base64 во вложении), тогда как
+        email.parser терпим к таким ошибкам: при отказе разбираем им.
+        """
+        if fast_mail_parser is not None:
+            try:
+                return fast_mail_parser.parse_email(content)
+            except fast_mail_parser.ParseError as e:
+                self.logger.warning('fast_mail_parser failed, falling back to email.parser: %s', e)
+        return parse_email_bytes(content)
 
     def extract_message_content(self, email_message) -> Dict:
         """Extract content from email message"""
+        if not isinstance(email_message, EmailMessage):
+            return self._extract_fast_parsed_content(email_message)
+
         parsed_email = {
             "mail_from": "",
             "rcpt_tos": [],
             "subject": email_message.get("subject", ""),
             "from": email_message.get("from", ""),
+            "from_display": "",
+            "from_addr": "",
             "to": email_message.get("to", ""),
             "cc": email_message.get("cc", ""),
             "bcc": email_message.get("bcc", ""),
-            "date": email_message.get("date", datetime.now().isoformat()),
+            # Текущее время форматируется только если в письме нет заголовка Date
+            "date": email_message.get("date") or datetime.now().isoformat(),
             "text_body": None,
             "html_body": None,
             "attachments": [],
@@ -136,150 +640,324 @@ class CustomSMTPHandler:
             "X-Host-Name": None
         }
 
+        # Имя и адрес отправителя раскодируем один раз на письмо
+        parsed_email["from_display"], parsed_email["from_addr"] = split_from_header(parsed_email["from"])
+
         if email_message.is_multipart():
-            for part in email_message.walk():
-                self._process_message_part(part, parsed_email)
+            self._process_multipart(email_message, parsed_email)
         else:
             content_type = email_message.get_content_type()
             if content_type == "text/plain":
-                parsed_email["text_body"] = email_message.get_payload(decode=True).decode().rstrip()
+                parsed_email["text_body"] = decode_text_part(email_message).rstrip()
             elif content_type == "text/html":
-                parsed_email["html_body"] = email_message.get_payload(decode=True).decode()
+                parsed_email["html_body"] = decode_text_part(email_message)
             else:
                 # Если это не текст, обрабатываем как вложение
                 self._process_attachment(email_message, parsed_email)
 
         return parsed_email
 
-    def _process_message_part(self, part, parsed_email: Dict) -> None:
-        """Process individual message part"""
-        if part.get_content_maintype() == 'multipart':
-            return
+    def _extract_fast_parsed_content(self, mail) -> Dict:
+        """Собирает содержимое письма из результата fast_mail_parser.
+
+        Структура совпадает с результатом разбора через email.parser: тексты
+        уже раскодированы парсером, вложения отдаются готовыми bytes.
+        """
+        headers = self._fast_headers(mail)
+
+        def first_header(name: str) -> str:
+            values = headers.get(name)
+            return values[0] if values else ""
+
+        parsed_email = {
+            "mail_from": "",
+            "rcpt_tos": [],
+            "subject": mail.subject,
+            "from": first_header("from"),
+            "from_display": "",
+            "from_addr": "",
+            "to": first_header("to"),
+            "cc": first_header("cc"),
+            "bcc": first_header("bcc"),
+            "date": mail.date or datetime.now().isoformat(),
+            "text_body": None,
+            "html_body": None,
+            "attachments": [],
+            "X-Client-IP": None,
+            "X-Host-Name": None
+        }
+        parsed_email["from_display"], parsed_email["from_addr"] = split_from_header(parsed_email["from"])
+
+        self._process_fast_parsed_parts(mail, parsed_email)
+        return parsed_email
+
+    @staticmethod
+    def _fast_headers(mail) -> Dict[str, List[str]]:
+        """Заголовки письма fast_mail_parser с именами в нижнем регистре.
+
+        Имена парсер отдает как в письме: без приведения FROM: и to: не
+        находились бы, в отличие от email.parser.
+        """
+        return {name.lower(): values for name, values in mail.headers.items()}
+
+    def _process_fast_parsed_parts(self, mail, parsed_email: Dict) -> None:
+        """Собирает тексты и вложения письма fast_mail_parser по правилам _process_multipart.
+
+        Встроенные письма (message/* без disposition attachment) разбираются
+        и обходятся на месте, как в email.parser. Части составного письма без
+        Content-Disposition (картинки multipart/related и т.п.) - оформление
+        HTML, а не вложения; неструктурное письмо, если это не текст,
+        отправляется вложением целиком.
+        """
+        if parsed_email["text_body"] is None and mail.text_plain:
+            parsed_email["text_body"] = mail.text_plain[0].rstrip()
+        if parsed_email["html_body"] is None and mail.text_html:
+            parsed_email["html_body"] = mail.text_html[0]
+
+        content_type_header = self._fast_headers(mail).get("content-type")
+        is_multipart = bool(content_type_header) and content_type_header[0].lower().startswith("multipart/")
+
+        for attachment in mail.attachments:
+            content_type = attachment.mimetype or 'application/octet-stream'
+            if content_type.lower().startswith("message/") and attachment.disposition != "attachment":
+                try:
+                    nested = fast_mail_parser.parse_email(attachment.content)
+                except fast_mail_parser.ParseError as e:
+                    self.logger.warning("Skipping unparsable embedded message: %s", e)
+                    continue
+                self._process_fast_parsed_parts(nested, parsed_email)
+                continue
+            if is_multipart and attachment.disposition is None:
+                continue
+            payload = attachment.content
+            filename = attachment.filename or default_attachment_name(
+                len(parsed_email["attachments"]), content_type
+            )
+            if not payload:
+                self.logger.error("Zero-length payload for %s", filename)
+                continue
+            parsed_email["attachments"].append({
+                "filename": filename,
+                "content_type": content_type,
+                "content": payload,
+                "content_disposition": attachment.disposition or "attachment",
+                "content_id": attachment.content_id or "",
+                "size": len(payload),
+                "encoding": "",
+                "charset": "utf-8",
+                "media_type": classify_media_type(content_type.lower())
+            })
+            self.logger.info("Attachment processed: %s type=%s size=%d", filename, content_type, len(payload))
+
+    def _process_multipart(self, email_message, parsed_email: Dict) -> None:
+        """Обходит части письма в глубину, по порядку следования.
+
+        В отличие от walk() не спускается внутрь вложенных писем, которые
+        сами отправляются вложением (message/* с disposition attachment):
+        их файлы не извлекаются повторно отдельными вложениями.
+        """
+        stack = [email_message]
+        while stack:
+            part = stack.pop()
+            maintype = part.get_content_maintype()
+            # 'attachment', 'inline' или None - без строкового поиска по заголовку
+            disposition = part.get_content_disposition()
+            if maintype == 'multipart' or (maintype == 'message' and disposition != 'attachment'):
+                stack.extend(reversed(list(part.iter_parts())))
+                continue
+            self._process_message_part(part, parsed_email, disposition)
 
+    def _process_message_part(self, part, parsed_email: Dict, disposition: Optional[str]) -> None:
+        """Process individual message part"""
         content_type = part.get_content_type()
-        content_disposition = str(part.get('Content-Disposition', ''))
-
-        if content_type == "text/plain" and 'attachment' not in content_disposition:
-            if parsed_email["text_body"] is None:
-                parsed_email["text_body"] = part.get_payload(decode=True).decode().rstrip()
-        elif content_type == "text/html" and 'attachment' not in content_disposition:
-            if parsed_email["html_body"] is None:
-                parsed_email["html_body"] = part.get_payload(decode=True).decode()
-        elif 'attachment' in content_disposition or 'inline' in content_disposition:
+
+        if disposition != 'attachment':
+            if content_type == "text/plain":
+                if parsed_email["text_body"] is None:
+                    parsed_email["text_body"] = decode_text_part(part).rstrip()
+                return
+            if content_type == "text/html":
+                if parsed_email["html_body"] is None:
+                    parsed_email["html_body"] = decode_text_part(part)
+                return
+
+        if disposition is not None:
             self._process_attachment(part, parsed_email)
 
     def _process_attachment(self, part, parsed_email: Dict) -> None:
         """Process email attachment"""
         try:
-            filename = part.get_filename()
-            if not filename:
-                ext = mimetypes.guess_extension(part.get_content_type()) or ''
-                filename = f'attachment_{len(parsed_email["attachments"])}{ext}'
+            content_type = part.get_content_type()
+            filename = part.get_filename() or default_attachment_name(
+                len(parsed_email["attachments"]), content_type
+            )
 
-            # Получаем содержимое в бинарном виде
-            payload = part.get_payload(decode=True)
-            
+            # Получаем содержимое в бинарном виде; для обычных вложений
+            # get_payload(decode=True) сразу отдает bytes
+            payload = decode_attachment_payload(part)
             if payload is None:
-                self.logger.warning(f"Empty payload for attachment: {filename}")
-                # Пробуем получить payload другим способом
-                payload = part.get_payload()
-                if isinstance(payload, str):
-                    payload = payload.encode('utf-8')
-                elif isinstance(payload, list):
-                    # Если payload это список, берем первый элемент
-                    if payload and hasattr(payload[0], 'get_payload'):
-                        payload = payload[0].get_payload(decode=True)
+                self.logger.warning("Empty payload for attachment: %s", filename)
+                payload = self._get_fallback_payload(part)
                 if payload is None:
                     self.logger.error("No valid payload found")
                     return
 
-            # Проверяем, что payload действительно в бинарном формате
-            if isinstance(payload, str):
-                payload = payload.encode('utf-8')
-
             # Проверяем корректность бинарных данных
-            if len(payload) == 0:
-                self.logger.error(f"Zero-length payload for {filename}")
+            if not payload:
+                self.logger.error("Zero-length payload for %s", filename)
                 return
 
             attachment_info = {
                 "filename": filename,
-                "content_type": part.get_content_type(),
+                "content_type": content_type,
                 "content": payload,
                 "content_disposition": str(part.get('Content-Disposition', 'attachment')),
                 "content_id": str(part.get('Content-ID', '')),
                 "size": len(payload),
                 "encoding": str(part.get('Content-Transfer-Encoding', '')),
-                "charset": str(part.get_content_charset() or 'utf-8')
+                "charset": str(part.get_content_charset() or 'utf-8'),
+                # Тип медиа Telegram определяется один раз при разборе письма
+                "media_type": classify_media_type(content_type)
             }
             
             self.logger.info(
-                f"Attachment processed:\n"
-                f"- Filename: {filename}\n"
-                f"- Type: {attachment_info['content_type']}\n"
-                f"- Size: {attachment_info['size']} bytes\n"
-                f"- Encoding: {attachment_info['encoding']}\n"
-                f"- Charset: {attachment_info['charset']}"
+                "Attachment processed: %s type=%s size=%d encoding=%s charset=%s",
+                filename,
+                attachment_info['content_type'],
+                attachment_info['size'],
+                attachment_info['encoding'],
+                attachment_info['charset']
             )
             
             parsed_email["attachments"].append(attachment_info)
             
         except Exception as e:
-            self.logger.error(f"Error processing attachment: {str(e)}", exc_info=True)
+            self.logger.error("Error processing attachment: %s", e, exc_info=True)
+
+    @staticmethod
+    def _get_fallback_payload(part) -> Optional[bytes]:
+        """Медленный путь: достает содержимое части, которую не удалось декодировать"""
+        payload = part.get_payload()
+        if isinstance(payload, list):
+            if part.get_content_maintype() == 'message' and payload:
+                # Вложенное письмо отправляем целиком, как файл .eml
+                return payload[0].as_bytes()
+            # Если payload это список, берем первый элемент
+            if payload and hasattr(payload[0], 'get_payload'):
+                payload = payload[0].get_payload(decode=True)
+            else:
+                return None
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        return payload
 
     def _is_local_recipient(self, email: str) -> bool:
         """Проверяет, является ли получатель локальным"""
-        _, addr = parseaddr(email)
-        return any(addr.endswith(f"@{domain}") for domain in self.config.local_domains)
+        return resolve_local_recipient(email, self.config.local_domains_set) is not None
 
     def _get_local_recipient_name(self, email: str) -> Optional[LocalRecipient]:
-        """Извлекает и парсит имя локального получателя без домна"""
-        _, addr = parseaddr(email)
-        for domain in self.config.local_domains:
-            if addr.endswith(f"@{domain}"):
-                local_name = addr.split(f"@{domain}")[0]
-                return LocalRecipient.parse(local_name)
-        return None
+        """Извлекает и парсит имя локального получателя без домена"""
+        resolved = resolve_local_recipient(email, self.config.local_domains_set)
+        return resolved[1] if resolved is not None else None
+
+    def _handle_local_delivery(self, message_dict: Dict) -> bool:
+        """Обработка сообщений для локальных получателей
 
-    def _handle_local_delivery(self, message_dict: Dict) -> None:
-        """Обработка сообщений для локальных получателей"""
+        За один проход по получателям определяет локальные домены и адресатов
+        в Telegram. Возвращает False, если локальных получателей нет.
+        """
         recipient_domains = set()
         local_recipients = []
         
         for rcpt in message_dict['rcpt_tos']:
-            _, addr = parseaddr(rcpt)
-            domain = addr.split('@')[-1]
-            if domain in self.config.local_domains:
-                recipient_domains.add(domain)
-                recipient = self._get_local_recipient_name(rcpt)
-                if recipient:
-                    local_recipients.append({
-                        'chat_id': recipient.chat_id,
-                        'message_thread_id': recipient.message_thread_id
-                    })
+            resolved = resolve_local_recipient(rcpt, self.config.local_domains_set)
+            if resolved is None:
+                continue
+            domain, recipient = resolved
+            recipient_domains.add(domain)
+            if recipient:
+                local_recipients.append({
+                    'chat_id': recipient.chat_id,
+                    'message_thread_id': recipient.message_thread_id
+                })
+
+        if not recipient_domains:
+            return False
         
-        self.logger.info(f"Processing local delivery for domains: {', '.join(recipient_domains)}")
+        self.logger.info("Processing local delivery for domains: %s", ', '.join(recipient_domains))
         message_dict['is_local_delivery'] = True
         message_dict['local_recipient_domains'] = list(recipient_domains)
         message_dict['local_recipients'] = local_recipients
+        return True
+
+    def _get_send_semaphore(self) -> asyncio.Semaphore:
+        """Семафор, ограничивающий число одновременных отправок в Telegram"""
+        if self._send_semaphore is None:
+            self._send_semaphore = asyncio.Semaphore(SETTINGS.telegram_max_concurrent_sends)
+        return self._send_semaphore
+
+    def _get_chat_limiter(self, chat_id: str) -> TokenBucket:
+        """Ограничитель частоты сообщений в один чат.
+
+        Идентификаторы чатов задает отправитель письма, поэтому храним только
+        RECIPIENT_CACHE_SIZE последних ограничителей и вытесняем самые давние.
+        """
+        limiter = self._chat_limiters.get(chat_id)
+        if limiter is None:
+            limiter = self._chat_limiters[chat_id] = TokenBucket(
+                SETTINGS.telegram_chat_rate_limit // self.config.worker_processes, 60
+            )
+            if len(self._chat_limiters) > RECIPIENT_CACHE_SIZE:
+                self._chat_limiters.popitem(last=False)
+        else:
+            self._chat_limiters.move_to_end(chat_id)
+        return limiter
+
+    async def _execute_with_retry(self, method: Callable[..., Awaitable[Any]], operation: str, /,
+                                  **kwargs) -> Any:
+        """Выполняет запрос к Telegram с повторами.
+
+        Метод бота вызывается с kwargs без промежуточных замыканий. Каждая
+        попытка сначала ждет токены общего лимита и лимита чата из kwargs['chat_id'].
+        Задержка перед повтором выбирается случайно от нуля до экспоненциально
+        растущего предела (full jitter), чтобы повторы разных отправок не шли
+        залпом. При flood control она не меньше retry_after, который просит Telegram.
+        """
+        for attempt in range(SETTINGS.telegram_max_retries + 1):
+            retry_after = 0.0
+            try:
+                async with self._get_chat_limiter(kwargs['chat_id']), self._global_limiter:
+                    return await method(**kwargs)
+            except RetryAfter as e:
+                if attempt == SETTINGS.telegram_max_retries:
+                    raise
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+            except BadRequest:
+                # Ошибка в самом запросе - повтор не поможет
+                raise
+            except NetworkError:
+                if attempt == SETTINGS.telegram_max_retries:
+                    raise
+            delay = max(retry_after, random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+            self.logger.warning(
+                "%s failed (attempt %d/%d), retrying in %.1fs",
+                operation, attempt + 1, SETTINGS.telegram_max_retries + 1, delay
+            )
+            await asyncio.sleep(delay)
 
     async def send_to_telegram(self, chat_id: str, message_thread_id: Optional[str], message_dict: Dict) -> bool:
         """Отправляет сообщение в Telegram"""
         try:
             # Формируем текст сообщения
-            text = f"📧 <b>Новое email сообщение</b>\n\n"
-            text += f"<b>От:</b> {html.escape(message_dict['from'])}\n"
-            text += f"<b>Тема:</b> {html.escape(message_dict['subject'])}\n\n"
-            
-            if message_dict['text_body']:
-                text += f"{html.escape(message_dict['text_body'][:4000])}..."
-            elif message_dict['html_body']:
-                clean_text = re.sub(r'<[^>]+>', '', message_dict['html_body'])
-                text += f"{html.escape(clean_text[:4000])}..."
+            text = format_preview_text(message_dict)
 
             # Если нет вложений, отправляем только текст
             if not message_dict['attachments']:
-                await self.bot.send_message(
+                await self._execute_with_retry(
+                    self.bot.send_message,
+                    'send_message',
                     chat_id=chat_id,
                     text=text,
                     parse_mode='HTML',
@@ -287,275 +965,363 @@ class CustomSMTPHandler:
                 )
                 return True
 
-            # Группируем вложения по типу
-            MEDIA_TYPES = {
-                'photo': {
-                    'image/',
-                    'application/png',
-                    'application/jpg',
-                    'application/jpeg'
-                },
-                'video': {
-                    'video/',
-                    'application/mp4',
-                    'application/mpeg'
-                },
-                'audio': {
-                    'audio/',
-                    'application/ogg',
-                    'application/mp3',
-                    'application/wav'
-                },
-                'animation': {
-                    'image/gif'
-                }
-            }
-
-            # Группируем вложения по типу
-            media_files = {
-                'photo': [],
-                'video': [],
-                'audio': [],
-                'animation': [],
-                'document': []
-            }
+            # Группируем вложения по типу. Боту передаются сами bytes вложений
+            # с именем файла: без промежуточных файловых объектов и копий
+            media_files: Dict[str, List[Dict]] = {}
+            sendable: List[Dict] = []
             
             for attachment in message_dict['attachments']:
                 if not attachment['content']:
                     continue
                     
-                content = attachment['content']
-                filename = attachment['filename']
-                content_type = attachment['content_type'].lower()
-                
-                # Создаем новый BytesIO для каждого файла
-                file_data = BytesIO(content)
-                file_data.seek(0)  # Убеждаемся, что указатель в начале
-                file_data.name = filename
-                
-                # Проверяем размер файла
-                file_size = len(content)
-                if file_size == 0:
-                    self.logger.error(f"Zero-size file detected: {filename}")
-                    continue
-                
-                self.logger.info(f"Processing file {filename} of type {content_type}, size: {file_size} bytes")
-                
-                # Определяем тип медиа
-                media_type = 'document'
-                for type_name, mime_types in MEDIA_TYPES.items():
-                    if any(content_type.startswith(mime_type) for mime_type in mime_types):
-                        media_type = type_name
-                        break
-                
-                media_files[media_type].append({
-                    'file': file_data,
-                    'filename': filename,
-                    'size': file_size
-                })
+                self.logger.info(
+                    "Processing file %s as %s, size: %d bytes",
+                    attachment['filename'], attachment['media_type'], attachment['size']
+                )
+                media_files.setdefault(attachment['media_type'], []).append(attachment)
+                sendable.append(attachment)
 
             # Проверяем, все ли файлы одного типа
-            non_empty_types = [(type_name, files) for type_name, files in media_files.items() if files]
-            if len(non_empty_types) == 1:
-                media_type, files = non_empty_types[0]
+            if len(media_files) == 1:
+                media_type, files = next(iter(media_files.items()))
+                
+                # Подпись к медиа короче сообщения: длинный текст уходит
+                # отдельным сообщением, а файлы - без подписи
+                caption = text if len(text) <= TELEGRAM_CAPTION_LIMIT else None
+                if caption is None:
+                    await self._execute_with_retry(
+                        self.bot.send_message,
+                        'send_message',
+                        chat_id=chat_id,
+                        text=text,
+                        parse_mode='HTML',
+                        message_thread_id=message_thread_id if message_thread_id else None
+                    )
                 
                 # Если файл один, отправляем его с текстом
                 if len(files) == 1:
-                    file = files[0]
-                    file['file'].seek(0)
-                    
-                    try:
-                        if media_type == 'photo':
-                            await self.bot.send_photo(
-                                chat_id=chat_id,
-                                photo=file['file'],
-                                caption=text,
-                                parse_mode='HTML',
-                                message_thread_id=message_thread_id if message_thread_id else None
-                            )
-                        elif media_type == 'video':
-                            await self.bot.send_video(
-                                chat_id=chat_id,
-                                video=file['file'],
-                                caption=text,
-                                parse_mode='HTML',
-                                message_thread_id=message_thread_id if message_thread_id else None
-                            )
-                        elif media_type == 'audio':
-                            await self.bot.send_audio(
-                                chat_id=chat_id,
-                                audio=file['file'],
-                                caption=text,
-                                parse_mode='HTML',
-                                message_thread_id=message_thread_id if message_thread_id else None
-                            )
-                        elif media_type == 'animation':
-                            await self.bot.send_animation(
-                                chat_id=chat_id,
-                                animation=file['file'],
-                                caption=text,
-                                parse_mode='HTML',
-                                message_thread_id=message_thread_id if message_thread_id else None
-                            )
-                        else:  # document
-                            await self.bot.send_document(
-                                chat_id=chat_id,
-                                document=file['file'],
-                                caption=text,
-                                parse_mode='HTML',
-                                message_thread_id=message_thread_id if message_thread_id else None
-                            )
-                    finally:
-                        file['file'].close()
-                    
+                    await self._send_file(chat_id, message_thread_id, media_type, files[0], caption)
                     return True
                 
-                # Если несколько файлов одного типа, отправляем их группой с текстом в первом файле
+                # Если несколько файлов одного типа, отправляем их группой с текстом в первом файле.
+                # Остаток сверх лимита медиагруппы уходит следующими группами
+                first_batch = files[:MEDIA_GROUP_LIMIT]
                 try:
-                    if media_type == 'photo':
-                        media_group = [
-                            InputMediaPhoto(
-                                media=files[0]['file'],
-                                caption=text,
-                                parse_mode='HTML'
-                            )
-                        ]
-                        media_group.extend([
-                            InputMediaPhoto(
-                                media=img['file']
-                            ) for img in files[1:]
-                        ])
-                    elif media_type == 'video':
-                        media_group = [
-                            InputMediaVideo(
-                                media=files[0]['file'],
-                                caption=text,
-                                parse_mode='HTML'
-                            )
-                        ]
-                        media_group.extend([
-                            InputMediaVideo(
-                                media=vid['file']
-                            ) for vid in files[1:]
-                        ])
-                    elif media_type == 'document':
-                        media_group = [
-                            InputMediaDocument(
-                                media=files[0]['file'],
-                                caption=text,
-                                parse_mode='HTML'
+                    media_class = INPUT_MEDIA_TYPES.get(media_type)
+                    if media_class is None:
+                        # Для других типов отправляем текст отдельно, если он еще не отправлен
+                        if caption is not None:
+                            await self._execute_with_retry(
+                                self.bot.send_message,
+                                'send_message',
+                                chat_id=chat_id,
+                                text=text,
+                                parse_mode='HTML',
+                                message_thread_id=message_thread_id if message_thread_id else None
                             )
-                        ]
-                        media_group.extend([
-                            InputMediaDocument(
-                                media=doc['file']
-                            ) for doc in files[1:]
-                        ])
-                    else:
-                        # Для других типов отправляем текст отдельно
-                        await self.bot.send_message(
-                            chat_id=chat_id,
-                            text=text,
-                            parse_mode='HTML',
-                            message_thread_id=message_thread_id if message_thread_id else None
-                        )
                         return await self._send_media_group(chat_id, message_thread_id, media_type, files)
 
-                    await self.bot.send_media_group(
+                    media_group = [
+                        media_class(
+                            media=file['content'],
+                            filename=file['filename'],
+                            caption=caption if index == 0 else None,
+                            parse_mode='HTML'
+                        ) for index, file in enumerate(first_batch)
+                    ]
+
+                    await self._execute_with_retry(
+                        self.bot.send_media_group,
+                        'send_media_group',
                         chat_id=chat_id,
                         media=media_group,
                         message_thread_id=message_thread_id if message_thread_id else None
                     )
+                    if len(files) > MEDIA_GROUP_LIMIT:
+                        return await self._send_media_group(
+                            chat_id, message_thread_id, media_type, files[MEDIA_GROUP_LIMIT:]
+                        )
                     return True
 
                 except Exception as e:
-                    self.logger.error(f"Failed to send media group: {str(e)}")
+                    self.logger.error("Failed to send media group: %s", e)
                     # Если не удалось отправить группой, отправляем текст и файлы по отдельности
-                    await self.bot.send_message(
-                        chat_id=chat_id,
-                        text=text,
-                        parse_mode='HTML',
-                        message_thread_id=message_thread_id if message_thread_id else None
-                    )
+                    if caption is not None:
+                        await self._execute_with_retry(
+                            self.bot.send_message,
+                            'send_message',
+                            chat_id=chat_id,
+                            text=text,
+                            parse_mode='HTML',
+                            message_thread_id=message_thread_id if message_thread_id else None
+                        )
                     return await self._send_files_individually(chat_id, message_thread_id, media_type, files)
 
-            # Если файлы разных типов, отправляем текст и группы файлов отдельно
-            await self.bot.send_message(
-                chat_id=chat_id,
-                text=text,
-                parse_mode='HTML',
-                message_thread_id=message_thread_id if message_thread_id else None
-            )
+            # Если файлы разных типов, фото и видео уходят одной смешанной
+            # медиагруппой в исходном порядке, остальные типы - своими группами
+            mixed_types = media_files.keys() & MIXABLE_MEDIA_TYPES
+            mixed_files: List[Dict] = []
+            if len(mixed_types) > 1:
+                mixed_files = [file for file in sendable if file['media_type'] in mixed_types]
+                for media_type in mixed_types:
+                    del media_files[media_type]
+
+            # Текст идет подписью, только если все файлы попали в смешанную группу
+            caption = text if not media_files and len(text) <= TELEGRAM_CAPTION_LIMIT else None
+            if caption is None:
+                await self._execute_with_retry(
+                    self.bot.send_message,
+                    'send_message',
+                    chat_id=chat_id,
+                    text=text,
+                    parse_mode='HTML',
+                    message_thread_id=message_thread_id if message_thread_id else None
+                )
+
+            if mixed_files:
+                await self._send_mixed_media_group(chat_id, message_thread_id, mixed_files, caption, text)
             
             # Отправляем каждую группу файлов
             for media_type, files in media_files.items():
-                if files:
-                    await self._send_media_group(chat_id, message_thread_id, media_type, files)
+                await self._send_media_group(chat_id, message_thread_id, media_type, files)
 
             return True
 
         except Exception as e:
-            self.logger.error(f"Error in send_to_telegram: {str(e)}", exc_info=True)
+            self.logger.error("Error in send_to_telegram: %s", e, exc_info=True)
             return False
 
     async def _send_media_group(self, chat_id: str, message_thread_id: Optional[str], media_type: str, files: List[Dict]) -> bool:
         """Вспомогательный метод для отправки группы медиафайлов"""
+        if len(files) > MEDIA_GROUP_LIMIT:
+            # Telegram принимает не больше MEDIA_GROUP_LIMIT файлов за запрос
+            success = True
+            for start in range(0, len(files), MEDIA_GROUP_LIMIT):
+                batch = files[start:start + MEDIA_GROUP_LIMIT]
+                if not await self._send_media_group(chat_id, message_thread_id, media_type, batch):
+                    success = False
+            return success
+
+        if len(files) == 1:
+            # Медиагруппа из одного файла Telegram не принимает - отправляем обычным методом
+            return await self._send_files_individually(chat_id, message_thread_id, media_type, files)
+
         try:
-            if media_type == 'photo':
-                media_group = [InputMediaPhoto(media=img['file']) for img in files]
-            elif media_type == 'video':
-                media_group = [InputMediaVideo(media=vid['file']) for vid in files]
-            elif media_type == 'document':
-                media_group = [InputMediaDocument(media=doc['file']) for doc in files]
-            else:
-                return False
+            media_class = INPUT_MEDIA_TYPES.get(media_type)
+            if media_class is None:
+                # Анимации в медиагруппы не входят - отправляем по одной
+                return await self._send_files_individually(chat_id, message_thread_id, media_type, files)
+            media_group = [media_class(media=file['content'], filename=file['filename']) for file in files]
 
-            await self.bot.send_media_group(
+            await self._execute_with_retry(
+                self.bot.send_media_group,
+                'send_media_group',
                 chat_id=chat_id,
                 media=media_group,
                 message_thread_id=message_thread_id if message_thread_id else None
             )
             return True
         except Exception as e:
-            self.logger.error(f"Failed to send media group: {str(e)}")
+            self.logger.error("Failed to send media group: %s", e)
             return await self._send_files_individually(chat_id, message_thread_id, media_type, files)
 
+    async def _send_mixed_media_group(self, chat_id: str, message_thread_id: Optional[str], files: List[Dict],
+                                      caption: Optional[str], text: str) -> bool:
+        """Отправляет фото и видео общими медиагруппами, подпись - у первого файла
+
+        Если смешанную группу отправить не удалось, текст (если он шел подписью)
+        отправляется отдельно, а файлы - группами по типам.
+        """
+        try:
+            for start in range(0, len(files), MEDIA_GROUP_LIMIT):
+                batch = files[start:start + MEDIA_GROUP_LIMIT]
+                if len(batch) == 1:
+                    # Последний файл без пары уходит обычным методом своего типа
+                    await self._send_file(chat_id, message_thread_id, batch[0]['media_type'], batch[0], caption)
+                    caption = None
+                    continue
+                media_group = [
+                    INPUT_MEDIA_TYPES[file['media_type']](
+                        media=file['content'],
+                        filename=file['filename'],
+                        caption=caption if index == 0 else None,
+                        parse_mode='HTML'
+                    ) for index, file in enumerate(batch)
+                ]
+                await self._execute_with_retry(
+                    self.bot.send_media_group,
+                    'send_media_group',
+                    chat_id=chat_id,
+                    media=media_group,
+                    message_thread_id=message_thread_id if message_thread_id else None
+                )
+                # Подпись уже доставлена с первой группой
+                caption = None
+            return True
+        except Exception as e:
+            self.logger.error("Failed to send mixed media group: %s", e)
+            if caption is not None:
+                await self._execute_with_retry(
+                    self.bot.send_message,
+                    'send_message',
+                    chat_id=chat_id,
+                    text=text,
+                    parse_mode='HTML',
+                    message_thread_id=message_thread_id if message_thread_id else None
+                )
+            success = True
+            for media_type in MIXABLE_MEDIA_TYPES:
+                remaining = [file for file in files[start:] if file['media_type'] == media_type]
+                if remaining and not await self._send_media_group(chat_id, message_thread_id, media_type, remaining):
+                    success = False
+            return success
+
+    async def _send_file(self, chat_id: str, message_thread_id: Optional[str], media_type: str, file: Dict,
+                         caption: Optional[str] = None) -> None:
+        """Отправляет один файл методом Bot API для его типа; неизвестные типы - документом"""
+        method_name, file_argument = MEDIA_SENDERS.get(media_type, MEDIA_SENDERS['document'])
+        method = getattr(self.bot, method_name)
+        await self._execute_with_retry(
+            method,
+            method_name,
+            chat_id=chat_id,
+            filename=file['filename'],
+            caption=caption,
+            parse_mode='HTML',
+            message_thread_id=message_thread_id if message_thread_id else None,
+            **{file_argument: file['content']}
+        )
+
     async def _send_files_individually(self, chat_id: str, message_thread_id: Optional[str], media_type: str, files: List[Dict]) -> bool:
         """Вспомогательный метод для отправки файлов по одному"""
         success = True
         for file in files:
             try:
-                file['file'].seek(0)
-                if media_type == 'photo':
-                    await self.bot.send_photo(
-                        chat_id=chat_id,
-                        photo=file['file'],
-                        message_thread_id=message_thread_id if message_thread_id else None
-                    )
-                elif media_type == 'document':
-                    await self.bot.send_document(
-                        chat_id=chat_id,
-                        document=file['file'],
-                        message_thread_id=message_thread_id if message_thread_id else None
-                    )
+                await self._send_file(chat_id, message_thread_id, media_type, file)
             except Exception as e:
-                self.logger.error(f"Failed to send individual file: {str(e)}")
+                self.logger.error("Failed to send individual file: %s", e)
                 success = False
-            finally:
-                file['file'].close()
         return success
 
+    def _get_delivery_queue(self) -> asyncio.Queue:
+        """Очередь писем на отправку в Telegram; при создании запускает обработчики"""
+        if self._delivery_queue is None:
+            self._delivery_queue = asyncio.Queue(maxsize=self.config.delivery_queue_size)
+            self._delivery_workers = [
+                asyncio.ensure_future(self._delivery_worker())
+                for _ in range(self.config.delivery_workers)
+            ]
+        return self._delivery_queue
+
+    async def _delivery_worker(self) -> None:
+        """Фоновая задача: забирает письма из очереди и отправляет их в Telegram"""
+        queue = self._delivery_queue
+        while True:
+            message_dict, stored = await queue.get()
+            status = 'failed'
+            try:
+                if not message_dict['local_recipients']:
+                    # Локальный домен без адресатов в Telegram: отправлять некому
+                    status = 'skipped'
+                else:
+                    if has_spooled_attachments(message_dict['attachments']):
+                        await asyncio.to_thread(load_attachments, message_dict['attachments'])
+                    if await self._deliver_message(message_dict):
+                        status = 'delivered'
+            except Exception as e:
+                self.logger.error('Error delivering message: %s', e, exc_info=True)
+            finally:
+                stored.delivery_status = status
+                # Не держим содержимое письма дольше, чем нужно для отправки
+                del message_dict
+                queue.task_done()
+
+    async def wait_for_deliveries(self) -> None:
+        """Ждет, пока все принятые письма будут отправлены в Telegram"""
+        if self._delivery_queue is not None:
+            await self._delivery_queue.join()
+
+    async def initialize_bot(self) -> None:
+        """Открывает пул соединений бота и проверяет токен до приема писем"""
+        try:
+            await self.bot.initialize()
+        except NetworkError as e:
+            # Telegram может стать доступен позже: отправки повторяются сами
+            self.logger.warning('Telegram is unreachable at startup: %s', e)
+
+    async def shutdown_bot(self) -> None:
+        """Закрывает пул соединений бота"""
+        await self.bot.shutdown()
+
+    async def stop_delivery(self) -> None:
+        """Останавливает фоновые задачи отправки"""
+        for worker in self._delivery_workers:
+            worker.cancel()
+        await asyncio.gather(*self._delivery_workers, return_exceptions=True)
+        self._delivery_workers = []
+        self._delivery_queue = None
+
+    async def _deliver_message(self, message_dict: Dict) -> bool:
+        """Отправляет письмо в Telegram всем локальным получателям параллельно
+
+        Возвращает True, если письмо доставлено всем получателям.
+        """
+        recipients = message_dict['local_recipients']
+        results = await asyncio.gather(
+            *(self._deliver_to_recipient(recipient, message_dict) for recipient in recipients),
+            return_exceptions=True
+        )
+        for recipient, result in zip(recipients, results):
+            if isinstance(result, BaseException):
+                self.logger.error(
+                    "Error delivering to Telegram chat %s: %s", recipient['chat_id'], result
+                )
+            if result is not True:
+                self.logger.warning("Failed to deliver message to Telegram chat %s", recipient['chat_id'])
+        return all(result is True for result in results)
+
+    async def _deliver_to_recipient(self, recipient: Dict, message_dict: Dict) -> bool:
+        """Отправляет письмо одному получателю с учетом лимита одновременных отправок
+
+        Письма в один чат отправляются по одному, чтобы сообщения и вложения
+        разных писем не перемешивались; разные чаты обслуживаются параллельно.
+        """
+        chat_id = recipient['chat_id']
+        chat_lock = self._chat_locks.get(chat_id)
+        if chat_lock is None:
+            chat_lock = self._chat_locks[chat_id] = asyncio.Lock()
+        self._chat_lock_users[chat_id] = self._chat_lock_users.get(chat_id, 0) + 1
+        try:
+            async with chat_lock, self._get_send_semaphore():
+                return await self.send_to_telegram(
+                    chat_id=chat_id,
+                    message_thread_id=recipient['message_thread_id'],
+                    message_dict=message_dict
+                )
+        finally:
+            users = self._chat_lock_users.pop(chat_id) - 1
+            if users:
+                self._chat_lock_users[chat_id] = users
+            else:
+                del self._chat_locks[chat_id]
+
     async def handle_DATA(self, server: SMTP, session: Session,
                          envelope: Envelope) -> str:
         """Handles incoming messages"""
         try:
-            is_valid, error_message = await self.validate_envelope(envelope)
-            if not is_valid:
-                return error_message
+            message_dict = {
+                'mail_from': envelope.mail_from,
+                # Неизменяемый снимок списка получателей: его разделяют очередь и история
+                'rcpt_tos': tuple(envelope.rcpt_tos),
+                'is_local_delivery': False
+            }
+
+            # Получатели известны из конверта до разбора письма. Без адресатов
+            # в Telegram (чужой домен или postmaster@ локального) тело не
+            # разбирается: для истории хватает заголовков
+            self._handle_local_delivery(message_dict)
+            has_chat_recipients = bool(message_dict.get('local_recipients'))
 
-            email_message = BytesParser(policy=default).parsebytes(envelope.content)
-            parsed_email = self.extract_message_content(email_message)
-            
             # Добавляем информацию о клиенте
             client_ip = ''
             if session and hasattr(session, 'peer') and session.peer:
@@ -565,47 +1331,82 @@ class CustomSMTPHandler:
             if session and hasattr(session, 'host_name'):
                 host_name = session.host_name
 
-            message_dict = {
+            # При полной очереди отказываем сразу, не тратя время на разбор
+            # письма и перенос вложений во временные файлы
+            if has_chat_recipients and self._get_delivery_queue().full():
+                self.logger.warning('Delivery queue is full, deferring message from %s', client_ip or 'unknown')
+                return '451 Delivery queue is full, try again later'
+
+            is_valid, error_message, email_message = await self.validate_envelope(
+                envelope, parse_body=has_chat_recipients
+            )
+            if not is_valid:
+                return error_message
+
+            if not has_chat_recipients:
+                self.messages.append(StoredMessage(
+                    mail_from=envelope.mail_from,
+                    rcpt_tos=message_dict['rcpt_tos'],
+                    subject=email_message.get('subject', ''),
+                    date=email_message.get('date') or datetime.now().isoformat(),
+                    size=len(envelope.content),
+                    attachment_count=None,
+                    is_local_delivery=message_dict['is_local_delivery']
+                ))
+                self.logger.info('Message accepted from %s (no Telegram recipients)', client_ip or 'unknown')
+                return '250 Message accepted for delivery'
+
+            parsed_email = await asyncio.to_thread(self.extract_message_content, email_message)
+
+            message_dict.update({
                 'from': parsed_email['from'],
+                'from_display': parsed_email['from_display'],
+                'from_addr': parsed_email['from_addr'],
                 'to': parsed_email['to'],
                 'subject': parsed_email['subject'],
                 'date': parsed_email['date'],
                 'text_body': parsed_email['text_body'],
                 'html_body': parsed_email['html_body'],
                 'attachments': parsed_email['attachments'],
-                'mail_from': envelope.mail_from,
-                'rcpt_tos': envelope.rcpt_tos.copy(),
                 'X-Client-IP': client_ip or '',
-                'X-Host-Name': host_name or '',
-                'is_local_delivery': False
-            }
-            
-            # Проверяем получателей а принадлежность к локальному домену
-            has_local_recipients = any(self._is_local_recipient(rcpt) for rcpt in envelope.rcpt_tos)
+                'X-Host-Name': host_name or ''
+            })
             
-            if has_local_recipients:
-                self._handle_local_delivery(message_dict)
-                # Отправляем сообщения в Telegram для каждого локального получателя
-                for recipient in message_dict['local_recipients']:
-                    success = await self.send_to_telegram(
-                        chat_id=recipient['chat_id'],
-                        message_thread_id=recipient['message_thread_id'],
-                        message_dict=message_dict
-                    )
-                    if not success:
-                        self.logger.warning(f"Failed to deliver message to Telegram chat {recipient['chat_id']}")
+            stored = StoredMessage(
+                mail_from=envelope.mail_from,
+                rcpt_tos=message_dict['rcpt_tos'],
+                subject=parsed_email['subject'],
+                date=parsed_email['date'],
+                size=len(envelope.content),
+                attachment_count=len(parsed_email['attachments']),
+                is_local_delivery=True,
+                # Отправка в Telegram идет в фоне: клиент получает ответ сразу после разбора
+                delivery_status='queued'
+            )
 
-            self.messages.append(message_dict)
+            if any(attachment['size'] > ATTACHMENT_SPOOL_SIZE for attachment in parsed_email['attachments']):
+                await asyncio.to_thread(spool_attachments, message_dict['attachments'])
+            try:
+                self._get_delivery_queue().put_nowait((message_dict, stored))
+            except asyncio.QueueFull:
+                # Очередь заполнилась, пока письмо разбиралось
+                discard_spooled_attachments(message_dict['attachments'])
+                self.logger.warning(
+                    'Delivery queue is full, deferring message from %s', client_ip or 'unknown'
+                )
+                return '451 Delivery queue is full, try again later'
+
+            self.messages.append(stored)
             
             self.logger.info(
-                f'Message accepted from {client_ip or "unknown"} '
-                f'with {len(parsed_email["attachments"])} attachments'
-                f'{" (local delivery)" if has_local_recipients else ""}'
+                'Message accepted from %s with %d attachments (local delivery)',
+                client_ip or 'unknown',
+                len(parsed_email['attachments'])
             )
             return '250 Message accepted for delivery'
 
         except Exception as e:
-            self.logger.error(f'Error processing message: {e}', exc_info=True)
+            self.logger.error('Error processing message: %s', e, exc_info=True)
             return '451 Requested action aborted: local error in processing'
 
     async def handle_QUIT(self, server: SMTP, session: Session,
@@ -614,13 +1415,31 @@ class CustomSMTPHandler:
         client_ip = 'unknown'
         if session and hasattr(session, 'peer') and session.peer:
             client_ip = session.peer[0]
-        self.logger.info(f'Client disconnected: {client_ip}')
+        self.logger.info('Client disconnected: %s', client_ip)
         return '221 Bye'
 
+class ReusePortController(aiosmtpd.controller.Controller):
+    """Controller, слушающий порт вместе с другими процессами (SO_REUSEPORT)"""
+
+    def _create_server(self):
+        return self.loop.create_server(
+            self._factory_invoker,
+            host=self.hostname,
+            port=self.port,
+            ssl=self.ssl_context,
+            reuse_port=True
+        )
+
+    def _trigger_server(self):
+        # Пробное соединение ядро может отдать соседнему процессу,
+        # поэтому фабрику SMTP проверяем вызовом в своем цикле событий
+        self.loop.call_soon_threadsafe(self._factory_invoker)
+
 async def start_server(config: ServerConfig) -> aiosmtpd.controller.Controller:
     """Start SMTP server"""
     handler = CustomSMTPHandler(config)
-    controller = aiosmtpd.controller.Controller(
+    controller_class = ReusePortController if config.worker_processes > 1 else aiosmtpd.controller.Controller
+    controller = controller_class(
         handler,
         hostname=config.hostname,
         port=config.port
@@ -628,12 +1447,28 @@ async def start_server(config: ServerConfig) -> aiosmtpd.controller.Controller:
     controller.start()
     return controller
 
+def setup_logging() -> logging.handlers.QueueListener:
+    """Настраивает логирование через очередь.
+
+    Обработчики SMTP только кладут записи в очередь, а запись в stderr
+    выполняет отдельный поток QueueListener.
+    """
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(
+        logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    )
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Окончательное форматирование делает stream_handler в потоке слушателя
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+    listener.start()
+    return listener
+
 async def main() -> None:
     """Main function to start the server"""
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
+    log_listener = setup_logging()
     logger = logging.getLogger(__name__)
     
     config = ServerConfig()
@@ -641,21 +1476,93 @@ async def main() -> None:
     
     try:
         server = await start_server(config)
-        logger.info(f'SMTP Server started on {config.hostname}:{config.port}')
-        logger.info(f'Handling local domains: {", ".join(config.local_domains)}')
+        # Бот работает в цикле событий контроллера - там же открываем его пул
+        await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(server.handler.initialize_bot(), server.loop)
+        )
+        logger.info('SMTP Server started on %s:%s', config.hostname, config.port)
+        logger.info('Handling local domains: %s', ', '.join(config.local_domains))
         
-        while True:
-            await asyncio.sleep(1)
-            
-    except KeyboardInterrupt:
+        # Ждем сигнала остановки без периодических пробуждений цикла;
+        # SIGTERM (docker stop) тоже проходит через штатное завершение
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, stop.set)
+            except NotImplementedError:
+                # На Windows обработчики сигналов цикла недоступны
+                pass
+        await stop.wait()
         logger.info("Shutting down server...")
+            
     except Exception as e:
-        logger.error(f'Server error: {e}', exc_info=True)
+        logger.error('Server error: %s', e, exc_info=True)
         raise
     finally:
         if server is not None:
+            # Даем фоновой отправке дослать уже принятые письма
+            drain = asyncio.run_coroutine_threadsafe(
+                server.handler.wait_for_deliveries(), server.loop
+            )
+            try:
+                drain.result(timeout=DELIVERY_DRAIN_TIMEOUT)
+            except Exception:
+                logger.warning('Pending Telegram deliveries were not finished before shutdown')
+            try:
+                asyncio.run_coroutine_threadsafe(
+                    server.handler.shutdown_bot(), server.loop
+                ).result(timeout=BOT_SHUTDOWN_TIMEOUT)
+            except Exception as e:
+                logger.warning('Failed to close Telegram connections: %s', e)
             server.stop()
             logger.info('Server stopped')
+        log_listener.stop()
 
-if __name__ == '__main__':
+def install_event_loop_policy() -> None:
+    """Включает uvloop, если он установлен.
+
+    Политика применяется и к циклу, который Controller создает в своем потоке.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+def run_worker_process() -> None:
+    """Точка входа одного из процессов, принимающих письма"""
+    install_event_loop_policy()
     asyncio.run(main())
+
+def run() -> None:
+    """Запускает сервер в одном или нескольких процессах.
+
+    При SMTP_WORKER_PROCESSES > 1 каждый процесс слушает тот же порт, и ядро
+    распределяет между ними соединения; разбор писем идет на нескольких ядрах.
+    Родительский процесс только передает им сигнал остановки.
+    """
+    worker_processes = SETTINGS.worker_processes
+    if worker_processes <= 1:
+        run_worker_process()
+        return
+
+    processes = [
+        multiprocessing.Process(target=run_worker_process, name=f'smtp-worker-{index}')
+        for index in range(worker_processes)
+    ]
+    for process in processes:
+        process.start()
+
+    def stop(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for process in processes:
+        process.join()
+
+if __name__ == '__main__':
+    run()
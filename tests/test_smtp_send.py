@@ -1,17 +1,19 @@
 import pytest
-import asyncio
+import pytest_asyncio
 import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
+from email.message import EmailMessage
 from pathlib import Path
 import os
-from config import SMTP_HOST, SMTP_PORT
-from smtp_server import ServerConfig, start_server
+from aiosmtpd.smtp import Envelope
+from config import SETTINGS
+from smtp_server import CustomSMTPHandler, ServerConfig, start_server
 from PIL import Image
 import io
+from test_smtp_server import FakeBot
 
-@pytest.fixture(scope="session")
+TEST_DOMAIN = "s.roskar.ru"
+
+@pytest_asyncio.fixture(scope="session")
 async def smtp_server():
     """Фикстура для запуска SMTP сервера"""
     config = ServerConfig()
@@ -20,39 +22,79 @@ async def smtp_server():
     server.stop()
 
 @pytest.fixture(scope="session")
-def event_loop():
-    """Создает экземпляр event loop для асинхронных фикстур"""
-    loop = asyncio.get_event_loop_policy().new_event_loop()
-    yield loop
-    loop.close()
+def png_bytes():
+    """PNG-изображения 100x100 по цветам, закодированные один раз на сессию"""
+    images = {}
+    for color in ('red', 'blue', 'green'):
+        buffer = io.BytesIO()
+        Image.new('RGB', (100, 100), color=color).save(buffer, format='PNG')
+        images[color] = buffer.getvalue()
+    return images
 
-@pytest.fixture
-def smtp_client(smtp_server):
-    """Фикстура для создания SMTP клиента"""
-    client = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
+@pytest.fixture(scope="session")
+def smtp_connection(smtp_server):
+    """Одно SMTP-соединение на все тесты сессии"""
+    client = smtplib.SMTP(SETTINGS.smtp_host, SETTINGS.smtp_port)
     yield client
     client.quit()
 
+@pytest.fixture
+def smtp_client(smtp_connection):
+    """Фикстура SMTP клиента: общее соединение со сброшенным конвертом.
+
+    Если сервер закрыл соединение в предыдущем тесте, подключается заново.
+    """
+    try:
+        smtp_connection.rset()
+    except smtplib.SMTPServerDisconnected:
+        smtp_connection.connect(SETTINGS.smtp_host, SETTINGS.smtp_port)
+    return smtp_connection
+
+@pytest.fixture
+async def handler_direct(monkeypatch):
+    """Обработчик SMTP для вызова handle_DATA без сокета и протокола SMTP.
+
+    Домен тестового получателя локальный, а вместо Telegram-бота заглушка,
+    запоминающая вызовы API.
+    """
+    monkeypatch.setattr(CustomSMTPHandler, '_bot', FakeBot())
+    handler = CustomSMTPHandler(ServerConfig(local_domains=[TEST_DOMAIN]))
+    yield handler
+    await handler.stop_delivery()
+
+async def _handle_and_deliver(handler, message) -> str:
+    """Передает письмо в handle_DATA и ждет фоновой отправки в Telegram"""
+    result = await handler.handle_DATA(None, None, _make_envelope(message))
+    await handler.wait_for_deliveries()
+    return result
+
+def _make_envelope(message) -> Envelope:
+    """Конверт с письмом, как его заполняет aiosmtpd после команды DATA"""
+    envelope = Envelope()
+    envelope.mail_from = message['From']
+    envelope.rcpt_tos = [message['To']]
+    envelope.content = message.as_bytes()
+    return envelope
+
 def create_test_message(
     sender: str = "sender@example.com",
-    recipient: str = "-1002174188126!60@s.roskar.ru",
+    recipient: str = f"-1002174188126!60@{TEST_DOMAIN}",
     subject: str = "Тестовое сообщение",
     body: str = "Это тестовое сообщение"
-) -> MIMEMultipart:
+) -> EmailMessage:
     """Создает тестовое сообщение"""
-    message = MIMEMultipart()
+    message = EmailMessage()
     message['From'] = sender
     message['To'] = recipient
     message['Subject'] = subject
 
     # Добавляем текстовую часть
-    text_part = MIMEText(body, 'plain')
-    message.attach(text_part)
+    message.set_content(body)
 
     return message
 
-def test_send_simple_message(smtp_client):
-    """Тест отправки простого текстового сообщения"""
+def test_send_simple_message_e2e(smtp_client):
+    """Тест отправки простого текстового сообщения через SMTP-соединение"""
     message = create_test_message()
     
     try:
@@ -61,38 +103,33 @@ def test_send_simple_message(smtp_client):
     except smtplib.SMTPException as e:
         pytest.fail(f"Ошибка при отправке сообщения: {e}")
 
-def test_send_message_with_attachment(smtp_client):
-    """Тест отправки сообщения с вложением"""
-    message = create_test_message(
-        subject="Тестовое сообщение с вложением",
-        body="Это тестовое сообщение с текстовым файлом во вложении"
-    )
-    
-    # Создаем тестовый файл
-    test_file_content = "Это содержимое тестового файла\nВторая строка\nТретья строка"
-    attachment = MIMEApplication(test_file_content.encode('utf-8'))
-    attachment.add_header('Content-Disposition', 'attachment', filename='test.txt')
-    message.attach(attachment)
-    
-    try:
-        result = smtp_client.send_message(message)
-        assert result == {}, "Сообщение с вложением должно быть отправлено успешно"
-    except smtplib.SMTPException as e:
-        pytest.fail(f"Ошибка при отправке сообщения с вложением: {e}")
+async def test_send_simple_message(handler_direct):
+    """Тест приема простого текстового сообщения"""
+    result = await _handle_and_deliver(handler_direct, create_test_message())
+    assert result.startswith("250"), "Сообщение должно быть принято"
+
+    [(method, kwargs)] = handler_direct.bot.calls
+    assert method == 'send_message'
+    assert kwargs['chat_id'] == '-1002174188126' and kwargs['message_thread_id'] == '60'
+    assert "Это тестовое сообщение" in kwargs['text']
 
 def test_send_large_message(smtp_client):
-    """Тест отправки большого сообщения"""
-    large_body = "A" * (1024 * 1024 * 2)  # 2MB текст
-    message = create_test_message(body=large_body)
-    
-    with pytest.raises(smtplib.SMTPResponseException):
-        smtp_client.send_message(message)
+    """Тест отказа в приеме письма, объявленный размер которого больше лимита сервера.
+
+    Клиент сообщает размер в MAIL FROM (расширение SIZE), и aiosmtpd отвечает
+    552 до команды DATA: само письмо не передается. Собственный лимит
+    max_message_size обработчика проверяется в test_smtp_server.py.
+    """
+    smtp_client.ehlo()
+    limit = int(smtp_client.esmtp_features['size'])
+    code, _ = smtp_client.mail("sender@example.com", ["SIZE=%d" % (limit + 1)])
+    assert code == 552
 
-def test_send_html_message(smtp_client):
-    """Тест отправки HTML сообщения"""
-    message = MIMEMultipart('alternative')
+async def test_send_html_message(handler_direct):
+    """Тест приема HTML сообщения"""
+    message = EmailMessage()
     message['From'] = "test@example.com"
-    message['To'] = "-1002174188126!60@s.roskar.ru"
+    message['To'] = f"-1002174188126!60@{TEST_DOMAIN}"
     message['Subject'] = "HTML Тест"
     
     html = """
@@ -104,134 +141,76 @@ def test_send_html_message(smtp_client):
     </html>
     """
     
-    html_part = MIMEText(html, 'html')
-    message.attach(html_part)
+    message.set_content(html, subtype='html')
     
-    try:
-        result = smtp_client.send_message(message)
-        assert result == {}, "HTML сообщение должно быть отправлено успешно"
-    except smtplib.SMTPException as e:
-        pytest.fail(f"Ошибка при отправке HTML сообщения: {e}")
+    result = await _handle_and_deliver(handler_direct, message)
+    assert result.startswith("250"), "HTML сообщение должно быть принято"
 
-def test_send_message_with_image(smtp_client):
-    """Тест отправки сообщения с изображением"""
-    message = create_test_message(subject="Тестовое сообщение с изображением")
-    
-    # Создаем реальное тестовое изображение
-    img = Image.new('RGB', (100, 100), color = 'red')
-    img_byte_arr = io.BytesIO()
-    img.save(img_byte_arr, format='PNG')
-    img_byte_arr = img_byte_arr.getvalue()
-    
-    # Прикрепляем изображение
-    image_attachment = MIMEApplication(img_byte_arr, _subtype="png")
-    image_attachment.add_header('Content-Disposition', 'attachment', filename='test_image.png')
-    message.attach(image_attachment)
-    
-    try:
-        result = smtp_client.send_message(message)
-        assert result == {}, "Сообщение с изображением должно быть отправлено успешно"
-    except smtplib.SMTPException as e:
-        pytest.fail(f"Ошибка при отправке сообщения с изображением: {e}")
+    # В Telegram уходит текст HTML-части без тегов письма
+    [(method, kwargs)] = handler_direct.bot.calls
+    assert method == 'send_message'
+    assert "Это жирный текст" in kwargs['text']
+    assert "<h1>" not in kwargs['text']
 
-def test_send_message_with_multiple_images(smtp_client):
-    """Тест отправки сообщения с несколькими изображениями"""
-    message = create_test_message(subject="Тестовое сообщение с несколькими изображениями")
-    
-    # Создаем несколько тестовых изображений разных цветов
-    colors = ['red', 'blue', 'green']
-    for i, color in enumerate(colors):
-        # Создаем изображение
-        img = Image.new('RGB', (100, 100), color=color)
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        img_byte_arr = img_byte_arr.getvalue()
-        
-        # Прикрепляем изображение
-        image_attachment = MIMEApplication(img_byte_arr, _subtype="png")
-        image_attachment.add_header(
-            'Content-Disposition', 
-            'attachment', 
-            filename=f'test_image_{i+1}_{color}.png'
-        )
-        message.attach(image_attachment)
-    
-    try:
-        result = smtp_client.send_message(message)
-        assert result == {}, "Сообщение с несколькими изображениями должно быть отправлено успешно"
-    except smtplib.SMTPException as e:
-        pytest.fail(f"Ошибка при отправке сообщения с несколькими изображениями: {e}")
+def _document_text(number: int) -> bytes:
+    """Содержимое тестового текстового документа"""
+    return (
+        f"Это содержимое текстового файла номер {number}\n"
+        "Тестовая строка 1\n"
+        "Тестовая строка 2\n"
+        "Тестовая строка 3"
+    ).encode('utf-8')
 
-def test_send_message_with_multiple_documents(smtp_client):
-    """Тест отправки сообщения с несколькими документами"""
-    message = create_test_message(subject="Тестовое сообщение с несколькими документами")
-    
-    # Создаем несколько тестовых текстовых документов
-    for i in range(3):
-        # Создаем текстовый контент
-        text_content = f"Это содержимое текстового файла номер {i+1}\n"
-        text_content += f"Тестовая строка 1\n"
-        text_content += f"Тестовая строка 2\n"
-        text_content += f"Тестовая строка 3"
-        
-        # Прикрепляем документ
-        doc_attachment = MIMEApplication(text_content.encode('utf-8'), _subtype="txt")
-        doc_attachment.add_header(
-            'Content-Disposition', 
-            'attachment', 
-            filename=f'test_document_{i+1}.txt'
-        )
-        message.attach(doc_attachment)
-    
-    try:
-        result = smtp_client.send_message(message)
-        assert result == {}, "Сообщение с несколькими документами должно быть отправлено успешно"
-    except smtplib.SMTPException as e:
-        pytest.fail(f"Ошибка при отправке сообщения с несколькими документами: {e}")
+def _sent_files(calls) -> list:
+    """Файлы, отправленные в Telegram, в виде (метод API, имя файла)"""
+    sent = []
+    for method, kwargs in calls:
+        if method == 'send_media_group':
+            sent.extend((method, item.media.filename) for item in kwargs['media'])
+        elif 'filename' in kwargs:
+            sent.append((method, kwargs['filename']))
+    return sent
 
-def test_send_message_with_mixed_attachments(smtp_client):
-    """Тест отправки сообщения с разными типами вложений"""
-    message = create_test_message(subject="Тестовое сообщение с разными вложениями")
-    
-    # Добавляем изображение
-    img = Image.new('RGB', (100, 100), color='red')
-    img_byte_arr = io.BytesIO()
-    img.save(img_byte_arr, format='PNG')
-    img_byte_arr = img_byte_arr.getvalue()
-    
-    image_attachment = MIMEApplication(img_byte_arr, _subtype="png")
-    image_attachment.add_header(
-        'Content-Disposition', 
-        'attachment', 
-        filename='test_image.png'
-    )
-    message.attach(image_attachment)
-    
-    # Добавляем текстовый файл 1
-    text_content1 = "Это первый текстовый файл\nС несколькими строками\nТекста"
-    text_attachment1 = MIMEApplication(text_content1.encode('utf-8'), _subtype="txt")
-    text_attachment1.add_header(
-        'Content-Disposition', 
-        'attachment', 
-        filename='test_document1.txt'
-    )
-    message.attach(text_attachment1)
-    
-    # Добавляем текстовый файл 2
-    text_content2 = "Это второй текстовый файл\nТоже с несколькими строками\nТекста"
-    text_attachment2 = MIMEApplication(text_content2.encode('utf-8'), _subtype="txt")
-    text_attachment2.add_header(
-        'Content-Disposition', 
-        'attachment', 
-        filename='test_document2.txt'
-    )
-    message.attach(text_attachment2)
-    
-    try:
-        result = smtp_client.send_message(message)
-        assert result == {}, "Сообщение с разными типами вложений должно быть отправлено успешно"
-    except smtplib.SMTPException as e:
-        pytest.fail(f"Ошибка при отправке сообщения с разными типами вложений: {e}")
+@pytest.mark.parametrize("subject, attachments, expected", [
+    ("Тестовое сообщение с вложением", [
+        ("Это содержимое тестового файла\nВторая строка\nТретья строка".encode('utf-8'), "application/octet-stream", "test.txt"),
+    ], [('send_document', "test.txt")]),
+    ("Тестовое сообщение с изображением", [
+        ("red", "image/png", "test_image.png"),
+    ], [('send_photo', "test_image.png")]),
+    ("Тестовое сообщение с несколькими изображениями", [
+        ("red", "image/png", "test_image_1_red.png"),
+        ("blue", "image/png", "test_image_2_blue.png"),
+        ("green", "image/png", "test_image_3_green.png"),
+    ], [('send_media_group', f"test_image_{number}_{color}.png")
+        for number, color in enumerate(('red', 'blue', 'green'), 1)]),
+    ("Тестовое сообщение с несколькими документами", [
+        (_document_text(number), "text/plain", f"test_document_{number}.txt") for number in range(1, 4)
+    ], [('send_media_group', f"test_document_{number}.txt") for number in range(1, 4)]),
+    ("Тестовое сообщение с разными вложениями", [
+        ("red", "image/png", "test_image.png"),
+        ("Это первый текстовый файл\nС несколькими строками\nТекста".encode('utf-8'), "text/plain", "test_document1.txt"),
+        ("Это второй текстовый файл\nТоже с несколькими строками\nТекста".encode('utf-8'), "text/plain", "test_document2.txt"),
+    ], [('send_photo', "test_image.png"),
+        ('send_media_group', "test_document1.txt"), ('send_media_group', "test_document2.txt")]),
+], ids=["attachment", "image", "multiple_images", "multiple_documents", "mixed_attachments"])
+async def test_send_message_with_attachments(handler_direct, png_bytes, subject, attachments, expected):
+    """Тест приема сообщения с вложениями и их отправки в Telegram.
+
+    Вложение задается как (содержимое, MIME-тип, имя файла); вместо содержимого
+    PNG указывается цвет изображения из фикстуры png_bytes. expected - файлы
+    в порядке отправки вместе с методом API, которым они отправлены.
+    """
+    message = create_test_message(subject=subject)
+    for content, mime_type, filename in attachments:
+        if isinstance(content, str):
+            content = png_bytes[content]
+        maintype, subtype = mime_type.split('/')
+        message.add_attachment(content, maintype=maintype, subtype=subtype, filename=filename)
+    
+    result = await _handle_and_deliver(handler_direct, message)
+    assert result.startswith("250"), "Сообщение с вложениями должно быть принято"
+    assert _sent_files(handler_direct.bot.calls) == expected
 
 if __name__ == '__main__':
     pytest.main([__file__]) 
\ No newline at end of file
@@ -0,0 +1,725 @@
+import asyncio
+import functools
+import smtplib
+import socket
+import time
+import pytest
+import smtp_server
+from email.message import EmailMessage
+from aiosmtpd.smtp import Envelope
+from telegram.error import NetworkError, RetryAfter
+from smtp_server import (
+    CustomSMTPHandler, ServerConfig, EmailValidator, LocalRecipient, ReusePortController, TokenBucket,
+    classify_media_type, decode_attachment_payload, decode_text_part, default_attachment_name,
+    discard_spooled_attachments, format_preview_text, has_required_header_values, has_required_headers,
+    has_spooled_attachments, header_block, load_attachments, resolve_local_recipient, split_from_header,
+    spool_attachments, strip_html_tags
+)
+
+class FakeBot:
+    """Заглушка Telegram-бота, запоминающая вызовы API"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        async def method(**kwargs):
+            self.calls.append((name, kwargs))
+            return True
+        return method
+
+@pytest.fixture(params=["fast_mail_parser", "email.parser"])
+async def handler(request, monkeypatch):
+    """Обработчик SMTP с заглушкой вместо Telegram-бота; прогоняется с обоими парсерами"""
+    if request.param == "email.parser":
+        monkeypatch.setattr(smtp_server, 'fast_mail_parser', None)
+    elif smtp_server.fast_mail_parser is None:
+        pytest.skip("fast_mail_parser is not installed")
+    monkeypatch.setattr(CustomSMTPHandler, '_bot', FakeBot())
+    handler = CustomSMTPHandler(ServerConfig(local_domains=['example.com']))
+    yield handler
+    await handler.stop_delivery()
+
+async def _handle_and_deliver(handler, envelope: Envelope) -> str:
+    """Передает конверт в handle_DATA и ждет фоновой отправки в Telegram"""
+    result = await handler.handle_DATA(None, None, envelope)
+    await handler.wait_for_deliveries()
+    return result
+
+@functools.lru_cache(maxsize=None)
+def _make_email_bytes(
+    from_addr: str = "sender@example.org",
+    to_addr: str = "-1002174188126!60@example.com",
+    subject: str = "Тестовое сообщение",
+    body: str = "Это тестовое сообщение"
+) -> bytes:
+    """Собирает байты письма; пустой адрес означает отсутствие заголовка.
+
+    Результат запоминается: тесты много раз собирают одни и те же письма.
+    """
+    message = EmailMessage()
+    if from_addr:
+        message['From'] = from_addr
+    if to_addr:
+        message['To'] = to_addr
+    message['Subject'] = subject
+    message.set_content(body)
+    return message.as_bytes()
+
+def _make_envelope(content: bytes, rcpt_tos=("-1002174188126!60@example.com",)) -> Envelope:
+    """Создает конверт, как его заполняет aiosmtpd"""
+    envelope = Envelope()
+    envelope.mail_from = "sender@example.org"
+    envelope.rcpt_tos = list(rcpt_tos)
+    envelope.content = content
+    return envelope
+
+async def test_validate_envelope_limits_and_headers(handler):
+    """Тест отказов validate_envelope: размер и обязательные заголовки"""
+    # Размер проверяется по длине до разбора: хватает маленького лимита и буфера
+    small_handler = CustomSMTPHandler(ServerConfig(local_domains=['example.com'], max_message_size=128))
+    is_valid, message, _ = await small_handler.validate_envelope(_make_envelope(bytes(129)))
+    assert not is_valid and message.startswith("552")
+    is_valid, message, _ = await small_handler.validate_envelope(_make_envelope(bytes(128)))
+    assert not message.startswith("552")
+
+    envelope = _make_envelope(b"Subject: x\r\n\r\n")
+    is_valid, message, _ = await handler.validate_envelope(envelope)
+    assert not is_valid and message.startswith("451")
+
+    envelope = _make_envelope(_make_email_bytes(from_addr=""))
+    is_valid, message, _ = await handler.validate_envelope(envelope)
+    assert not is_valid and message == '451 Missing required headers'
+
+    envelope = _make_envelope(_make_email_bytes(to_addr=""))
+    is_valid, message, _ = await handler.validate_envelope(envelope)
+    assert not is_valid and message == '451 Missing required headers'
+
+async def test_validate_envelope_returns_parsed_message(handler):
+    """Тест того, что validate_envelope отдает разобранное письмо для повторного использования"""
+    envelope = _make_envelope(_make_email_bytes(subject="Проверка"))
+    is_valid, message, email_message = await handler.validate_envelope(envelope)
+    assert is_valid and message == ''
+    assert handler.extract_message_content(email_message)['subject'] == "Проверка"
+
+async def test_handle_data_processes_local_delivery(handler):
+    """Тест доставки письма локальному получателю в Telegram"""
+    envelope = _make_envelope(_make_email_bytes())
+    result = await _handle_and_deliver(handler, envelope)
+    assert result.startswith("250")
+    assert [name for name, _ in handler.bot.calls] == ['send_message']
+    _, kwargs = handler.bot.calls[0]
+    assert kwargs['chat_id'] == '-1002174188126'
+    assert kwargs['message_thread_id'] == '60'
+
+@pytest.mark.parametrize("address,expected", [
+    ("user.name+tag@example.com", True),
+    ("Имя <user@mail.example.org>", True),
+    ("user@localhost", False),
+    ("user@example.c", False),
+    ("user@example.c0m", False),
+    ("user@@example.com", False),
+    ("@example.com", False),
+    ("", False),
+])
+def test_email_validator(address, expected):
+    """Тест проверки формата email-адреса"""
+    assert EmailValidator.is_valid_email(address) is expected
+
+async def test_handle_data_matches_local_domain_case_insensitively(handler):
+    """Тест того, что домен получателя сравнивается без учета регистра"""
+    envelope = _make_envelope(_make_email_bytes(), rcpt_tos=["id42@Example.COM"])
+    assert (await _handle_and_deliver(handler, envelope)).startswith("250")
+    assert handler.bot.calls[0][1]['chat_id'] == '42'
+
+async def test_handle_data_skips_non_local_recipients(handler, monkeypatch):
+    """Тест того, что письма на чужие домены не разбираются и не отправляются в Telegram"""
+    def fail(*args, **kwargs):
+        raise AssertionError("message body must not be parsed")
+
+    monkeypatch.setattr(handler, '_parse_email', fail)
+    monkeypatch.setattr(handler, 'extract_message_content', fail)
+    envelope = _make_envelope(_make_email_bytes(subject="Чужое"), rcpt_tos=["42@other.org"])
+    assert (await _handle_and_deliver(handler, envelope)).startswith("250")
+    assert handler.bot.calls == []
+    stored = handler.messages[-1]
+    assert stored.is_local_delivery is False
+    assert stored.delivery_status == 'skipped'
+    assert stored.subject == "Чужое"
+    assert stored.attachment_count is None
+
+async def test_local_mail_without_chat_recipients_is_skipped(handler, monkeypatch):
+    """Тест того, что письмо на локальный домен без адресатов-чатов не разбирается и не отправляется"""
+    def fail(*args, **kwargs):
+        raise AssertionError("message body must not be parsed")
+
+    monkeypatch.setattr(handler, '_parse_email', fail)
+    envelope = _make_envelope(_make_email_bytes(), rcpt_tos=["postmaster@example.com"])
+    assert (await _handle_and_deliver(handler, envelope)).startswith("250")
+    assert handler.bot.calls == []
+    stored = handler.messages[-1]
+    assert stored.is_local_delivery is True
+    assert stored.delivery_status == 'skipped'
+    assert stored.attachment_count is None
+
+async def test_handle_data_delivers_to_every_local_recipient(handler):
+    """Тест доставки одного письма нескольким локальным получателям"""
+    envelope = _make_envelope(
+        _make_email_bytes(),
+        rcpt_tos=["id1@example.com", "2_7@example.com", "3@other.org"]
+    )
+    assert (await _handle_and_deliver(handler, envelope)).startswith("250")
+    sent = sorted((kwargs['chat_id'], kwargs['message_thread_id']) for _, kwargs in handler.bot.calls)
+    assert sent == [('1', None), ('2', '7')]
+
+async def test_handle_data_stores_only_message_summary(handler):
+    """Тест того, что в истории остаются только метаданные письма"""
+    message = EmailMessage()
+    message['From'] = "sender@example.org"
+    message['To'] = "1@example.com"
+    message['Subject'] = "С вложением"
+    message.set_content("Текст письма")
+    message.add_attachment(b"x" * 1024, maintype="application", subtype="octet-stream", filename="data.bin")
+    envelope = _make_envelope(message.as_bytes(), rcpt_tos=["1@example.com"])
+
+    assert (await _handle_and_deliver(handler, envelope)).startswith("250")
+    stored = handler.messages[-1]
+    assert stored.subject == "С вложением"
+    assert stored.attachment_count == 1
+    assert stored.size == len(envelope.content)
+    assert stored.delivery_status == 'delivered'
+    assert not hasattr(stored, 'attachments')
+
+def _make_email_with_attachments(*attachments) -> bytes:
+    """Собирает письмо с вложениями вида (content, maintype, subtype, filename)"""
+    message = EmailMessage()
+    message['From'] = "sender@example.org"
+    message['To'] = "1@example.com"
+    message['Subject'] = "Вложения"
+    message.set_content("Текст письма")
+    for content, maintype, subtype, filename in attachments:
+        message.add_attachment(content, maintype=maintype, subtype=subtype, filename=filename)
+    return message.as_bytes()
+
+async def test_headers_are_matched_case_insensitively(handler):
+    """Тест того, что заголовки FROM: и to: читаются независимо от регистра имени"""
+    content = b"FROM: Sender <sender@example.org>\r\nto: 1@example.com\r\nSubject: x\r\n\r\nbody\r\n"
+    _, _, email_message = await handler.validate_envelope(_make_envelope(content))
+    parsed = handler.extract_message_content(email_message)
+    assert parsed['from_addr'] == "sender@example.org"
+    assert parsed['to'] == "1@example.com"
+
+async def test_corrupt_base64_attachment_is_still_delivered(handler):
+    """Тест того, что битый base64 во вложении не мешает доставить письмо"""
+    content = _make_email_with_attachments((b"%PDF-1.4", "application", "pdf", "doc.pdf"))
+    content = content.replace(b"JVBERi0xLjQ=", b"!!!not*base64@@")
+    envelope = _make_envelope(content, rcpt_tos=["1@example.com"])
+    assert (await _handle_and_deliver(handler, envelope)).startswith("250")
+    assert handler.messages[-1].delivery_status == 'delivered'
+    [(method, kwargs)] = handler.bot.calls
+    assert method == 'send_document' and kwargs['filename'] == "doc.pdf"
+
+async def test_inline_related_images_are_not_sent_as_attachments(handler):
+    """Тест того, что картинки multipart/related без Content-Disposition не считаются вложениями"""
+    message = EmailMessage()
+    message['From'] = "sender@example.org"
+    message['To'] = "1@example.com"
+    message['Subject'] = "HTML"
+    message.set_content("Текст письма")
+    message.add_alternative('<p>Текст письма <img src="cid:logo"></p>', subtype="html")
+    html_part = message.get_payload()[1]
+    html_part.add_related(b"\x89PNG" + b"0" * 64, maintype="image", subtype="png", cid="<logo>")
+    del html_part.get_payload()[1]['Content-Disposition']
+    message.add_attachment(b"%PDF-1.4", maintype="application", subtype="pdf", filename="doc.pdf")
+
+    _, _, email_message = await handler.validate_envelope(_make_envelope(message.as_bytes()))
+    attachments = handler.extract_message_content(email_message)['attachments']
+    assert [attachment['filename'] for attachment in attachments] == ["doc.pdf"]
+
+@pytest.mark.parametrize("disposition", [None, "inline"])
+async def test_embedded_message_attachments_are_extracted(handler, disposition):
+    """Тест того, что вложения встроенного письма без disposition attachment извлекаются обоими парсерами"""
+    inner = EmailMessage()
+    inner['From'] = "other@example.org"
+    inner['To'] = "someone@example.org"
+    inner['Subject'] = "Пересланное"
+    inner.set_content("Текст пересланного письма")
+    inner.add_attachment(b"%PDF-1.4", maintype="application", subtype="pdf", filename="nested.pdf")
+    message = EmailMessage()
+    message['From'] = "sender@example.org"
+    message['To'] = "1@example.com"
+    message['Subject'] = "Пересылка"
+    message.set_content("Текст письма")
+    message.add_attachment(inner)
+    embedded = message.get_payload()[1]
+    del embedded['Content-Disposition']
+    if disposition:
+        embedded['Content-Disposition'] = disposition
+
+    _, _, email_message = await handler.validate_envelope(_make_envelope(message.as_bytes()))
+    parsed = handler.extract_message_content(email_message)
+    assert parsed['text_body'] == "Текст письма"
+    assert [attachment['filename'] for attachment in parsed['attachments']] == ["nested.pdf"]
+
+async def test_single_attachment_is_sent_with_caption(handler):
+    """Тест отправки единственного вложения одним запросом с подписью"""
+    content = _make_email_with_attachments((b"\x89PNG" + b"0" * 64, "image", "png", "one.png"))
+    envelope = _make_envelope(content, rcpt_tos=["1@example.com"])
+    assert (await _handle_and_deliver(handler, envelope)).startswith("250")
+
+    [(method, kwargs)] = handler.bot.calls
+    assert method == 'send_photo'
+    assert kwargs['filename'] == "one.png"
+    assert kwargs['photo'] == b"\x89PNG" + b"0" * 64
+    assert "Вложения" in kwargs['caption']
+
+async def test_long_text_is_sent_before_uncaptioned_media(handler):
+    """Тест отправки длинного текста отдельным сообщением: подпись к медиа короче"""
+    message = EmailMessage()
+    message['From'] = "sender@example.org"
+    message['To'] = "1@example.com"
+    message['Subject'] = "Длинное письмо"
+    message.set_content("Строка текста. " * 200)
+    message.add_attachment(b"\x89PNG" + b"0" * 64, maintype="image", subtype="png", filename="one.png")
+    envelope = _make_envelope(message.as_bytes(), rcpt_tos=["1@example.com"])
+    assert (await _handle_and_deliver(handler, envelope)).startswith("250")
+
+    [(first, message_kwargs), (second, photo_kwargs)] = handler.bot.calls
+    assert (first, second) == ('send_message', 'send_photo')
+    assert len(message_kwargs['text']) > 1024
+    assert photo_kwargs['caption'] is None
+
+async def test_attached_message_is_kept_as_single_file(handler):
+    """Тест того, что вложенное письмо передается одним файлом .eml"""
+    inner = EmailMessage()
+    inner['From'] = "other@example.org"
+    inner['To'] = "sender@example.org"
+    inner['Subject'] = "Пересланное"
+    inner.set_content("Текст пересланного письма")
+    inner.add_attachment(b"%PDF inner", maintype="application", subtype="pdf", filename="inner.pdf")
+    outer = EmailMessage()
+    outer['From'] = "sender@example.org"
+    outer['To'] = "1@example.com"
+    outer['Subject'] = "Пересылка"
+    outer.set_content("Текст письма")
+    outer.add_attachment(inner, filename="forwarded.eml")
+
+    is_valid, _, email_message = await handler.validate_envelope(_make_envelope(outer.as_bytes()))
+    assert is_valid
+    parsed_email = handler.extract_message_content(email_message)
+    assert parsed_email['text_body'] == "Текст письма"
+    [attachment] = parsed_email['attachments']
+    assert attachment['filename'] == "forwarded.eml"
+    assert b"inner.pdf" in attachment['content']
+
+async def test_mixed_attachments_are_sent_by_type(handler):
+    """Тест отправки вложений разных типов: текст и затем группы по типам"""
+    content = _make_email_with_attachments(
+        (b"\x89PNG" + b"1" * 64, "image", "png", "one.png"),
+        (b"%PDF" + b"2" * 64, "application", "pdf", "two.pdf"),
+    )
+    envelope = _make_envelope(content, rcpt_tos=["1@example.com"])
+    assert (await _handle_and_deliver(handler, envelope)).startswith("250")
+    # По одному файлу каждого типа - отдельными запросами, а не медиагруппами
+    assert [method for method, _ in handler.bot.calls] == [
+        'send_message', 'send_photo', 'send_document'
+    ]
+
+async def test_photos_and_videos_are_sent_as_one_media_group(handler):
+    """Тест отправки фото и видео одной медиагруппой с текстом в подписи"""
+    content = _make_email_with_attachments(
+        (b"\x89PNG" + b"1" * 64, "image", "png", "one.png"),
+        (b"\x00\x00\x00\x18ftypmp42" + b"2" * 64, "video", "mp4", "two.mp4"),
+        (b"\x89PNG" + b"3" * 64, "image", "png", "three.png"),
+    )
+    envelope = _make_envelope(content, rcpt_tos=["1@example.com"])
+    assert (await _handle_and_deliver(handler, envelope)).startswith("250")
+    [(method, kwargs)] = handler.bot.calls
+    assert method == 'send_media_group'
+    media = kwargs['media']
+    assert [type(item).__name__ for item in media] == ['InputMediaPhoto', 'InputMediaVideo', 'InputMediaPhoto']
+    assert "Вложения" in media[0].caption
+    assert media[1].caption is None
+
+class SlowFakeBot(FakeBot):
+    """Заглушка бота, отвечающая с задержкой и считающая одновременные запросы"""
+
+    def __init__(self):
+        super().__init__()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def __getattr__(self, name):
+        async def method(**kwargs):
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(0.01)
+            self.in_flight -= 1
+            self.calls.append((name, kwargs))
+            return True
+        return method
+
+async def test_messages_to_one_chat_are_sent_one_at_a_time(monkeypatch):
+    """Тест того, что письма в один чат не отправляются параллельно"""
+    bot = SlowFakeBot()
+    monkeypatch.setattr(CustomSMTPHandler, '_bot', bot)
+    handler = CustomSMTPHandler(ServerConfig(local_domains=['example.com']))
+    try:
+        for _ in range(3):
+            envelope = _make_envelope(_make_email_bytes(), rcpt_tos=["1@example.com"])
+            assert (await handler.handle_DATA(None, None, envelope)).startswith("250")
+        await handler.wait_for_deliveries()
+        assert len(bot.calls) == 3
+        assert bot.max_in_flight == 1
+        # Блокировка чата удаляется, когда ее больше никто не ждет
+        assert handler._chat_locks == {} and handler._chat_lock_users == {}
+    finally:
+        await handler.stop_delivery()
+
+class BlockingFakeBot(FakeBot):
+    """Заглушка бота, не отвечающая, пока тест не разрешит"""
+
+    def __init__(self):
+        super().__init__()
+        self.release = asyncio.Event()
+
+    def __getattr__(self, name):
+        async def method(**kwargs):
+            await self.release.wait()
+            self.calls.append((name, kwargs))
+            return True
+        return method
+
+async def test_handle_data_defers_when_delivery_queue_is_full(monkeypatch):
+    """Тест ответа 451, когда очередь отправки в Telegram заполнена"""
+    bot = BlockingFakeBot()
+    monkeypatch.setattr(CustomSMTPHandler, '_bot', bot)
+    handler = CustomSMTPHandler(
+        ServerConfig(local_domains=['example.com'], delivery_queue_size=1, delivery_workers=1)
+    )
+    try:
+        # Первое письмо занимает единственный обработчик, второе - место в очереди
+        result = await handler.handle_DATA(None, None, _make_envelope(_make_email_bytes()))
+        assert result.startswith("250")
+        while not handler._delivery_queue.empty():
+            await asyncio.sleep(0)
+        result = await handler.handle_DATA(None, None, _make_envelope(_make_email_bytes()))
+        assert result.startswith("250")
+
+        # При полной очереди письмо отклоняется до разбора
+        def fail(*args, **kwargs):
+            raise AssertionError("message body must not be parsed")
+
+        monkeypatch.setattr(handler, '_parse_email', fail)
+        result = await handler.handle_DATA(None, None, _make_envelope(_make_email_bytes()))
+        assert result.startswith("451")
+        bot.release.set()
+        await handler.wait_for_deliveries()
+        assert len(bot.calls) == 2
+    finally:
+        await handler.stop_delivery()
+
+@pytest.mark.parametrize("body, charset", [
+    ("plain ascii body", "us-ascii"),
+    ("Привет из KOI8-R", "koi8-r"),
+    ("Привет из UTF-8", "utf-8"),
+])
+def test_decode_text_part_uses_declared_charset(body, charset):
+    """Тест декодирования текстовой части по ее charset"""
+    message = EmailMessage()
+    message.set_content(body, charset=charset)
+    assert decode_text_part(message).rstrip() == body
+
+def test_decode_text_part_guesses_undeclared_charset():
+    """Тест декодирования текста без charset в заголовке"""
+    if smtp_server.detect_encodings is None:
+        pytest.skip("charset-normalizer is not installed")
+    body = "Привет! Это письмо отправлено без указания кодировки."
+    message = EmailMessage()
+    message['Content-Type'] = 'text/plain'
+    message['Content-Transfer-Encoding'] = '8bit'
+    message.set_payload(body.encode('cp1251'))
+    assert decode_text_part(message) == body
+
+def test_decode_text_part_replaces_invalid_bytes():
+    """Тест того, что некорректные байты не роняют разбор письма"""
+    message = EmailMessage()
+    message.set_content(b"caf\xe9 \xff", maintype="text", subtype="plain", cte="8bit")
+    message.set_param("charset", "utf-8")
+    assert decode_text_part(message) == "caf\ufffd \ufffd"
+
+@pytest.mark.parametrize("content_type, media_type", [
+    ("image/png", "photo"),
+    ("application/jpeg", "photo"),
+    ("image/gif", "animation"),
+    ("video/mp4", "video"),
+    ("application/mpeg", "video"),
+    ("audio/ogg", "audio"),
+    ("application/ogg", "audio"),
+    ("application/pdf", "document"),
+    ("text/plain", "document"),
+])
+def test_classify_media_type(content_type, media_type):
+    """Тест определения типа медиа Telegram по MIME-типу"""
+    assert classify_media_type(content_type) == media_type
+
+@pytest.mark.parametrize("cte", ["base64", "quoted-printable"])
+def test_decode_attachment_payload_matches_stdlib(cte):
+    """Тест совпадения быстрого декодирования вложений со стандартным"""
+    content = bytes(range(256)) * 64
+    message = EmailMessage()
+    message.add_attachment(content, maintype="application", subtype="octet-stream", cte=cte)
+    part = next(message.iter_attachments())
+    assert decode_attachment_payload(part) == part.get_payload(decode=True) == content
+
+def test_decode_attachment_payload_falls_back_on_broken_padding():
+    """Тест разбора base64 с потерянным выравниванием через стандартный путь"""
+    message = EmailMessage()
+    message.add_attachment(b"abcd", maintype="application", subtype="octet-stream")
+    part = next(message.iter_attachments())
+    part.set_payload(part.get_payload().rstrip().rstrip("="))
+    assert decode_attachment_payload(part) == part.get_payload(decode=True)
+
+def _make_message_dict(text_body=None, html_body=None) -> dict:
+    """Минимальный message_dict для формирования превью"""
+    return {
+        'from': 'Отправитель <sender@example.org>',
+        'subject': 'Тема & "кавычки"',
+        'text_body': text_body,
+        'html_body': html_body,
+    }
+
+def test_format_preview_text_escapes_only_html_specials():
+    """Тест экранирования превью без замены кавычек"""
+    text = format_preview_text(_make_message_dict(text_body="a < b"))
+    assert "&lt;sender@example.org&gt;" in text
+    assert 'Тема &amp; "кавычки"' in text
+    assert text.endswith("a &lt; b...")
+
+def test_format_preview_text_fits_telegram_limit():
+    """Тест того, что экранированное превью не превышает лимит Telegram"""
+    message_dict = _make_message_dict(text_body="&" * 10000)
+    text = format_preview_text(message_dict)
+    assert len(text) <= 4096
+    assert text.endswith("&amp;...")
+    assert format_preview_text(message_dict) is text
+
+def test_format_preview_text_strips_html_tags():
+    """Тест превью из html_body при отсутствии текстовой части"""
+    text = format_preview_text(_make_message_dict(html_body="<p>Привет</p>"))
+    assert text.endswith("Привет...")
+
+@pytest.mark.parametrize("content, expected", [
+    (b"From: a@example.org\r\nTo: b@example.com\r\n\r\nbody", True),
+    (b"FROM: a@example.org\nto: b@example.com\n\nbody", True),
+    (b"Subject: x\r\nFrom: a@example.org\r\nTo: b@example.com\r\n", True),
+    (b"From: a@example.org\r\nReply-To: b@example.com\r\n\r\nbody", False),
+    (b"From: a@example.org\r\n\r\nTo: b@example.com\r\n", False),
+])
+def test_has_required_headers(content, expected):
+    """Тест быстрой проверки заголовков по сырым байтам"""
+    assert has_required_headers(header_block(content)) is expected
+
+@pytest.mark.parametrize("headers, expected", [
+    (b"From: a@example.org\r\nTo: b@example.com", True),
+    (b"From: a@example.org\r\nTo:\r\n \r\nSubject: x", False),
+    (b"From: \r\nTo: b@example.com", False),
+])
+def test_has_required_header_values(headers, expected):
+    """Тест проверки непустых заголовков по одному блоку заголовков"""
+    assert has_required_header_values(smtp_server.HEADER_PARSER.parsebytes(headers)) is expected
+
+@pytest.mark.parametrize("local_name, expected", [
+    ("42", LocalRecipient(chat_id="42")),
+    ("id42", LocalRecipient(chat_id="42")),
+    ("-1002174188126", LocalRecipient(chat_id="-1002174188126")),
+    ("-1002174188126!60", LocalRecipient(chat_id="-1002174188126", message_thread_id="60")),
+    ("id-100_7", LocalRecipient(chat_id="-100", message_thread_id="7")),
+    ("did123", None),
+    ("i123", None),
+    ("1_2_3", None),
+    ("postmaster", None),
+    ("", None),
+])
+def test_local_recipient_parse(local_name, expected):
+    """Тест разбора локального имени в chat_id и message_thread_id"""
+    assert LocalRecipient.parse(local_name) == expected
+
+@pytest.mark.parametrize("from_header, expected", [
+    ("=?utf-8?b?0JjQstCw0L0=?= <ivan@example.org>", ("Иван", "ivan@example.org")),
+    ("plain@example.org", ("", "plain@example.org")),
+])
+def test_split_from_header_decodes_encoded_words(from_header, expected):
+    """Тест раскодирования отправителя как из строки, так и из заголовка письма"""
+    assert split_from_header(from_header) == expected
+    message = EmailMessage()
+    message['From'] = from_header
+    assert split_from_header(message['From']) == expected
+
+async def test_preview_shows_decoded_sender(handler):
+    """Тест того, что в Telegram уходит раскодированное имя отправителя"""
+    envelope = _make_envelope(
+        _make_email_bytes(from_addr="=?utf-8?b?0JjQstCw0L0=?= <ivan@example.org>"),
+        rcpt_tos=["1@example.com"]
+    )
+    assert (await _handle_and_deliver(handler, envelope)).startswith("250")
+    [(_, kwargs)] = handler.bot.calls
+    assert "<b>От:</b> Иван &lt;ivan@example.org&gt;" in kwargs['text']
+
+def test_resolve_local_recipient_is_cached():
+    """Тест разбора получателя и кэширования результата по исходному адресу"""
+    domains = frozenset({"example.com"})
+    resolve_local_recipient.cache_clear()
+    assert resolve_local_recipient("<id5!9@Example.com>", domains) == (
+        "example.com", LocalRecipient(chat_id="5", message_thread_id="9")
+    )
+    assert resolve_local_recipient("postmaster@example.com", domains) == ("example.com", None)
+    assert resolve_local_recipient("5@other.org", domains) is None
+    resolve_local_recipient("<id5!9@Example.com>", domains)
+    assert resolve_local_recipient.cache_info().hits == 1
+
+@pytest.mark.parametrize("content_type, expected", [
+    ("image/png", "attachment_2.png"),
+    ("application/pdf", "attachment_2.pdf"),
+    ("application/x-unknown-type", "attachment_2"),
+])
+def test_default_attachment_name(content_type, expected):
+    """Тест имени вложения без filename"""
+    assert default_attachment_name(2, content_type) == expected
+
+async def test_token_bucket_limits_rate():
+    """Тест того, что ограничитель выдает не больше rate токенов за period"""
+    bucket = TokenBucket(2, 0.2)
+    start = time.monotonic()
+    # Два токена доступны сразу, следующие пополняются по одному за 0.1 с
+    for _ in range(4):
+        async with bucket:
+            pass
+    assert time.monotonic() - start >= 0.18
+
+def test_chat_limiters_keep_only_recent_chats(monkeypatch):
+    """Тест того, что ограничители чатов не копятся без предела"""
+    monkeypatch.setattr(smtp_server, 'RECIPIENT_CACHE_SIZE', 2)
+    monkeypatch.setattr(CustomSMTPHandler, '_bot', FakeBot())
+    handler = CustomSMTPHandler(ServerConfig(local_domains=['example.com']))
+    first = handler._get_chat_limiter('1')
+    handler._get_chat_limiter('2')
+    assert handler._get_chat_limiter('1') is first
+    handler._get_chat_limiter('3')
+    assert list(handler._chat_limiters) == ['1', '3']
+
+async def test_retry_delay_uses_full_jitter_and_retry_after(handler, monkeypatch):
+    """Тест задержек повтора: случайная до экспоненциального предела, но не меньше retry_after"""
+    delays = []
+    real_sleep = asyncio.sleep
+
+    async def fake_sleep(delay, *args, **kwargs):
+        delays.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(smtp_server.asyncio, 'sleep', fake_sleep)
+    monkeypatch.setattr(smtp_server.random, 'uniform', lambda low, high: high)
+    errors = [RetryAfter(5), NetworkError("connection reset")]
+
+    async def request(**kwargs):
+        if errors:
+            raise errors.pop(0)
+        return kwargs['text']
+
+    assert await handler._execute_with_retry(request, 'send_message', chat_id="1", text="ok") == "ok"
+    assert delays == [5, smtp_server.RETRY_BASE_DELAY * 2]
+
+@pytest.mark.parametrize("html_body", [
+    "<p>" + "текст " * 100 + "</p>" + "<div>хвост</div>" * 1000,
+    "<p>короткий</p>" + "<br>" * 1000,
+    "<a " + "x" * 100 + ">ссылка</a>" + "слово " * 100,
+])
+def test_strip_html_tags_matches_full_pass(html_body):
+    """Тест того, что вырезание тегов из начала документа дает тот же текст"""
+    full = smtp_server.HTML_TAG_RE.sub('', html_body)
+    assert strip_html_tags(html_body, 20)[:20] == full[:20]
+
+@pytest.mark.parametrize("media_type, method, argument", [
+    ("photo", "send_photo", "photo"),
+    ("video", "send_video", "video"),
+    ("audio", "send_audio", "audio"),
+    ("animation", "send_animation", "animation"),
+    ("document", "send_document", "document"),
+])
+async def test_files_are_sent_individually_by_type(handler, media_type, method, argument):
+    """Тест выбора метода Bot API по типу медиа при отправке файлов по одному"""
+    file = {'content': b"data", 'filename': "file.bin"}
+    assert await handler._send_files_individually("1", None, media_type, [file])
+    [(called, kwargs)] = handler.bot.calls
+    assert called == method
+    assert kwargs[argument] == b"data"
+    assert kwargs['filename'] == "file.bin"
+
+def test_spooled_attachments_are_loaded_back(monkeypatch):
+    """Тест переноса крупных вложений во временные файлы и обратно"""
+    monkeypatch.setattr(smtp_server, 'ATTACHMENT_SPOOL_SIZE', 16)
+    attachments = [{'content': b"small"}, {'content': b"x" * 64}]
+    spool_attachments(attachments)
+    assert attachments[0]['content'] == b"small"
+    assert has_spooled_attachments(attachments)
+    load_attachments(attachments)
+    assert not has_spooled_attachments(attachments)
+    assert attachments[1]['content'] == b"x" * 64
+
+def test_discard_spooled_attachments_closes_files(monkeypatch):
+    """Тест закрытия временных файлов вложений неотправляемого письма"""
+    monkeypatch.setattr(smtp_server, 'ATTACHMENT_SPOOL_SIZE', 16)
+    attachments = [{'content': b"small"}, {'content': b"x" * 64}]
+    spool_attachments(attachments)
+    discard_spooled_attachments(attachments)
+    assert attachments[1]['content'].closed
+
+async def test_large_attachment_is_delivered_after_spooling(handler, monkeypatch):
+    """Тест отправки вложения, ждавшего в очереди во временном файле"""
+    monkeypatch.setattr(smtp_server, 'ATTACHMENT_SPOOL_SIZE', 16)
+    payload = b"%PDF" + b"x" * 64
+    content = _make_email_with_attachments((payload, "application", "pdf", "big.pdf"))
+    envelope = _make_envelope(content, rcpt_tos=["1@example.com"])
+    assert (await _handle_and_deliver(handler, envelope)).startswith("250")
+    [(method, kwargs)] = handler.bot.calls
+    assert method == 'send_document'
+    assert kwargs['document'] == payload
+
+async def test_mixed_media_group_sends_last_single_file_directly(handler):
+    """Тест того, что файл, оставшийся без пары после полной медиагруппы, отправляется отдельно"""
+    files = [
+        {'content': b"data", 'filename': "file%d.png" % index, 'media_type': 'photo' if index % 2 else 'video'}
+        for index in range(smtp_server.MEDIA_GROUP_LIMIT + 1)
+    ]
+    assert await handler._send_mixed_media_group("1", None, files, "подпись", "подпись")
+    methods = [method for method, _ in handler.bot.calls]
+    assert methods == ['send_media_group', 'send_video']
+    assert handler.bot.calls[0][1]['media'][0].caption == "подпись"
+    assert handler.bot.calls[1][1]['caption'] is None
+
+def test_reuse_port_controllers_share_one_port(monkeypatch):
+    """Тест того, что несколько процессов-обработчиков могут слушать один порт"""
+    monkeypatch.setattr(CustomSMTPHandler, '_bot', FakeBot())
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    config = ServerConfig(local_domains=['example.com'], worker_processes=2)
+    controllers = [
+        ReusePortController(CustomSMTPHandler(config), hostname="127.0.0.1", port=port)
+        for _ in range(2)
+    ]
+    try:
+        for controller in controllers:
+            controller.start()
+        with smtplib.SMTP("127.0.0.1", port) as client:
+            assert client.noop()[0] == 250
+    finally:
+        for controller in controllers:
+            controller.stop()
+
+def test_worker_processes_cannot_exceed_rate_limits():
+    """Тест того, что процессов не больше, чем запросов в лимитах Telegram"""
+    limit = min(smtp_server.SETTINGS.telegram_global_rate_limit, smtp_server.SETTINGS.telegram_chat_rate_limit)
+    ServerConfig(local_domains=['example.com'], worker_processes=limit)
+    with pytest.raises(ValueError):
+        ServerConfig(local_domains=['example.com'], worker_processes=limit + 1)